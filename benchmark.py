@@ -0,0 +1,335 @@
+"""Benchmarks for "динамика вм.py": a synthetic export generator and per-stage timings.
+
+    python benchmark.py generate --rows 100000 --days 30 -o export.xlsx
+    python benchmark.py run --rows 10000 100000 500000 2000000 --days 14 -o benchmark_results.json
+    python benchmark.py startup
+"""
+import argparse
+import importlib.util
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import date, datetime, timedelta
+
+import numpy as np
+import pandas as pd
+import openpyxl
+from openpyxl import Workbook
+
+
+SCRIPT_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "динамика вм.py")
+
+DEFAULT_ROWS = [10000, 100000, 500000, 2000000]
+
+STAGES = ['load', 'apply_filters', 'calculate_dynamics_and_color', 'sheet_writing', 'add_chart_to_sheet', 'save']
+
+# Справка, список файлов и проверка аргументов не должны ждать тяжелых библиотек
+STARTUP_BUDGET_SECONDS = 0.2
+STARTUP_REPEATS = 10
+
+BRAND_TERMS = ['бренд', 'brandname', 'магазин бренд']
+
+WORDS = ['купить', 'цена', 'отзывы', 'доставка', 'москва', 'недорого', 'интернет', 'магазин', 'каталог', 'спб',
+         'скидки', 'официальный', 'сайт', 'заказать', 'онлайн', 'акция', 'новый', 'размер', 'черный', 'белый']
+
+
+def load_script():
+    """Import the analysis script as a module (its file name is not a valid module name)."""
+    if 'wm' in sys.modules:
+        return sys.modules['wm']
+    spec = importlib.util.spec_from_file_location('wm', SCRIPT_PATH)
+    module = importlib.util.module_from_spec(spec)
+    # Модуль регистрируется до выполнения, чтобы его функции сериализовались для процессов
+    sys.modules['wm'] = module
+    spec.loader.exec_module(module)
+    return module
+
+
+def zipf_ids(rng, size, cardinality, exponent=1.2):
+    """Draw ids in [0, cardinality) with a Zipf-like skew: a few ids are very frequent, most are rare."""
+    weights = 1.0 / np.arange(1, cardinality + 1) ** exponent
+    return rng.choice(cardinality, size=size, p=weights / weights.sum())
+
+
+def generate_export(rows, days=30, metrics=None, seed=0, start=date(2024, 1, 1), brand_share=0.1):
+    """Build a synthetic "Мониторинг запросов" export as a DataFrame.
+
+    Query and URL popularity is skewed (Zipf-like) and every (Query, Url) pair is unique, as in real exports.
+    Shows follow a per-pair popularity, clicks are drawn from shows and are mostly zero; position and CTR
+    are empty on days without shows.
+    """
+    wm = load_script()
+    metrics = [metric for metric in wm.METRICS if metric in (metrics or wm.METRICS)]
+    rng = np.random.default_rng(seed)
+
+    # Уникальные пары запрос/URL с перекосом по популярности
+    query_cardinality = max(rows // 2, 10)
+    url_cardinality = max(rows // 20, 5)
+    pairs = pd.DataFrame(columns=['query', 'url'], dtype=np.int64)
+    while len(pairs) < rows:
+        extra = int((rows - len(pairs)) * 1.5) + 10
+        sample = pd.DataFrame({'query': zipf_ids(rng, extra, query_cardinality, 1.05),
+                               'url': zipf_ids(rng, extra, url_cardinality)})
+        pairs = pd.concat([pairs, sample]).drop_duplicates(ignore_index=True)
+    pairs = pairs.iloc[:rows]
+
+    query_ids = pairs['query'].to_numpy()
+    vocabulary = np.array(WORDS)
+    word_count = len(vocabulary)
+    queries = np.array([" ".join(vocabulary[[(query_id * 7 + offset) % word_count
+                                              for offset in range(1 + query_id % 3)]]) + f" {query_id}"
+                        for query_id in range(query_cardinality)], dtype=object)
+    is_brand = rng.random(query_cardinality) < brand_share
+    queries[is_brand] = [f"{BRAND_TERMS[query_id % len(BRAND_TERMS)]} {query}"
+                         for query_id, query in zip(np.flatnonzero(is_brand), queries[is_brand])]
+    data = {
+        'Query': queries[query_ids],
+        'Url': [f"https://example.ru/section{url_id % 40}/page{url_id}/" for url_id in pairs['url'].to_numpy()],
+    }
+
+    popularity = rng.lognormal(mean=0.0, sigma=1.5, size=rows)
+    demand = rng.lognormal(mean=2.0, sigma=1.5, size=rows)
+    click_rate = rng.beta(0.5, 12, size=rows)
+    base_position = rng.uniform(1, 50, size=rows)
+    for day in range(days):
+        column_date = (start + timedelta(days=day)).isoformat()
+        shows = rng.poisson(popularity)
+        clicks = rng.binomial(shows, click_rate)
+        has_shows = shows > 0
+        values = {
+            'shows': shows.astype(float),
+            'position': np.where(has_shows, np.round(base_position + rng.normal(0, 2, rows).clip(-5, 5), 1), np.nan),
+            'demand': rng.poisson(demand).astype(float),
+            'ctr': np.where(has_shows, np.round(clicks / np.maximum(shows, 1) * 100, 2), np.nan),
+            'clicks': clicks.astype(float),
+        }
+        for metric in metrics:
+            data[f"{column_date}_{metric}"] = values[metric]
+    return pd.DataFrame(data)
+
+
+def write_export(data, path):
+    """Write a generated export with a write-only workbook, continuing on new sheets past Excel's row limit."""
+    wm = load_script()
+    wb = Workbook(write_only=True)
+    capacity = wm.EXCEL_MAX_ROWS - 1
+    columns = data.columns.tolist()
+    for start in range(0, max(len(data), 1), capacity):
+        ws = wb.create_sheet(title=f"Sheet{start // capacity + 1}")
+        ws.append(columns)
+        for row in data.iloc[start:start + capacity].itertuples(index=False, name=None):
+            ws.append([None if value != value else value for value in row])
+    wb.save(path)
+
+
+def measure(records, rows, stage, rows_in, func, *args):
+    """Run one stage, append its timing record and return its result."""
+    started, cpu_started = time.perf_counter(), time.process_time()
+    result = func(*args)
+    seconds = time.perf_counter() - started
+    rows_out = len(result) if isinstance(result, pd.DataFrame) else rows_in
+    records.append({
+        'rows': rows, 'stage': stage, 'seconds': round(seconds, 6),
+        'cpu_seconds': round(time.process_time() - cpu_started, 6),
+        'rows_in': rows_in, 'rows_out': rows_out,
+        'rows_per_second': round(rows_in / seconds, 1) if seconds else None,
+    })
+    print(f"{rows:>9} строк  {stage:<30} {seconds:9.3f} с", file=sys.stderr)
+    return result
+
+
+def compute_results(data, metrics):
+    """The dynamics stage: parse the metric columns once and build every metric's result table."""
+    wm = load_script()
+    cube = wm.build_metric_cube(data, metrics)
+    query_values, url_values = data['Query'].array, data['Url'].array
+    results = {}
+    for metric_idx, value_type in enumerate(cube['metrics']):
+        if cube['present'][metric_idx].any():
+            results[value_type] = (wm.metric_result_frame(query_values, url_values, cube, value_type),
+                                   wm.metric_day_values(cube, value_type)[1])
+    return results
+
+
+def write_sheets(wb, results, coloring):
+    """The sheet writing stage: stream every metric's rows into its (possibly split) sheet."""
+    wm = load_script()
+    sheets = []
+    for value_type, (sheet_data, day_values) in results.items():
+        sheet = wm.open_metric_sheet(wb, value_type, sheet_data.columns.tolist(), day_values.shape[1], coloring)
+        wm.append_metric_rows(sheet, sheet_data, day_values)
+        sheets.append(sheet)
+    return sheets
+
+
+def close_sheets(sheets):
+    """The chart stage: "Итого" rows, coloring rules and charts of every metric sheet."""
+    wm = load_script()
+    for sheet in sheets:
+        wm.close_metric_sheet(sheet)
+
+
+def run_size(rows, days, metrics, seed, work_dir, load, coloring):
+    """Time every stage for one export size and return the stage records."""
+    wm = load_script()
+    records = []
+    data = generate_export(rows, days, metrics, seed)
+
+    if load:
+        input_path = os.path.join(work_dir, f"export_{rows}x{days}_{'-'.join(metrics)}_s{seed}.xlsx")
+        if not os.path.exists(input_path):
+            print(f"Генерация {input_path}...", file=sys.stderr)
+            write_export(data, input_path)
+        # Выгрузка больше одного листа читается через объединение листов
+        read = wm.read_export if rows < wm.EXCEL_MAX_ROWS else (lambda path: wm.merge_exports([path], metrics))
+        data = measure(records, rows, 'load', rows, read, input_path)
+
+    # Фильтр исключает брендовые запросы: самый дорогой из фильтров
+    data = wm.encode_text_columns(data)
+    filtered = measure(records, rows, 'apply_filters', len(data), wm.apply_filters, data, [], [], BRAND_TERMS,
+                       False, False, True, False)
+    del data
+    results = measure(records, rows, 'calculate_dynamics_and_color', len(filtered), compute_results, filtered,
+                      metrics)
+
+    wb = Workbook(write_only=True)
+    sheets = measure(records, rows, 'sheet_writing', len(filtered), write_sheets, wb, results, coloring)
+    del results
+    measure(records, rows, 'add_chart_to_sheet', len(filtered), close_sheets, sheets)
+    output_path = os.path.join(work_dir, f"processed_{rows}.xlsx")
+    measure(records, rows, 'save', len(filtered), wb.save, output_path)
+    os.remove(output_path)
+    return records
+
+
+def startup_cases(work_dir):
+    """Command lines that must finish without loading pandas, openpyxl or tqdm: (name, arguments, stdin)."""
+    return [
+        ('interpreter', ['-c', 'pass'], None),
+        ('help', [SCRIPT_PATH, '--help'], None),
+        ('validate', [SCRIPT_PATH, os.path.join(work_dir, 'missing.xlsx')], None),
+        # Интерактивный режим выводит список файлов; номер 0 завершает его без обработки
+        ('list', [SCRIPT_PATH], '0\n'),
+    ]
+
+
+def measure_startup(repeats=STARTUP_REPEATS):
+    """Time fresh interpreter runs of the script's light paths; the interpreter case is the baseline."""
+    with tempfile.TemporaryDirectory(prefix='wm_startup_') as work_dir:
+        # Файл нужен только для списка в интерактивном режиме: номер 0 завершает его до чтения
+        open(os.path.join(work_dir, 'export.xlsx'), 'wb').close()
+        return [time_startup_case(case, arguments, stdin, work_dir, repeats)
+                for case, arguments, stdin in startup_cases(work_dir)]
+
+
+def time_startup_case(case, arguments, stdin, work_dir, repeats):
+    """Run one startup case repeats times and return its timing record."""
+    timings = []
+    for _ in range(repeats):
+        started = time.perf_counter()
+        subprocess.run([sys.executable, *arguments], input=stdin, cwd=work_dir, text=True,
+                       stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        timings.append(time.perf_counter() - started)
+    seconds, median = min(timings), statistics.median(timings)
+    print(f"запуск {case:<12} {seconds:9.3f} с (медиана {median:.3f} с)", file=sys.stderr)
+    return {
+        'stage': 'startup', 'case': case, 'seconds': round(seconds, 6), 'median_seconds': round(median, 6),
+        'repeats': repeats, 'within_budget': seconds <= STARTUP_BUDGET_SECONDS,
+    }
+
+
+def environment():
+    """Describe the machine and library versions the results were measured with."""
+    try:
+        commit = subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=os.path.dirname(SCRIPT_PATH),
+                                capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    return {
+        'python': platform.python_version(), 'platform': platform.platform(), 'cpu_count': os.cpu_count(),
+        'numpy': np.__version__, 'pandas': pd.__version__, 'openpyxl': openpyxl.__version__,
+        'python_calamine': load_script().calamine_available(),
+        'commit': commit,
+    }
+
+
+def build_arg_parser():
+    """Build the benchmark command line."""
+    wm = load_script()
+    parser = argparse.ArgumentParser(description="Генератор выгрузок и замеры скорости по этапам обработки.")
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    generate = commands.add_parser('generate', help="создать синтетическую выгрузку")
+    generate.add_argument('--rows', type=int, default=10000, help="число строк (по умолчанию 10000)")
+    generate.add_argument('-o', '--output', required=True, help="файл выгрузки .xlsx")
+
+    run = commands.add_parser('run', help="замерить этапы обработки на выгрузках разного размера")
+    run.add_argument('--rows', type=int, nargs='+', default=DEFAULT_ROWS,
+                     help=f"размеры выгрузок в строках (по умолчанию {' '.join(map(str, DEFAULT_ROWS))})")
+    run.add_argument('-o', '--output', default='benchmark_results.json',
+                     help="JSON с результатами (по умолчанию benchmark_results.json)")
+    run.add_argument('--work-dir', help="папка для сгенерированных выгрузок (по умолчанию временная)")
+    run.add_argument('--no-load', action='store_true',
+                     help="не создавать Excel-выгрузки и не замерять чтение (генерация больших файлов долгая)")
+    run.add_argument('--coloring', choices=['fill', 'conditional'], default='fill',
+                     help="способ раскраски листов (по умолчанию fill)")
+
+    startup = commands.add_parser('startup', help="замерить время запуска без обработки данных")
+    for command in (run, startup):
+        command.add_argument('--startup-repeats', type=int, default=STARTUP_REPEATS,
+                             help=f"повторов замера запуска, 0 в run — без замера (по умолчанию {STARTUP_REPEATS})")
+
+    for command in (generate, run):
+        command.add_argument('--days', type=int, default=14, help="число дней (по умолчанию 14)")
+        command.add_argument('--metrics', nargs='+', choices=wm.METRICS, default=wm.METRICS, metavar='METRIC',
+                             help="показатели (по умолчанию все)")
+        command.add_argument('--seed', type=int, default=0, help="зерно генератора (по умолчанию 0)")
+    return parser
+
+
+def main(argv=None):
+    args = build_arg_parser().parse_args(argv)
+    if args.command == 'generate':
+        write_export(generate_export(args.rows, args.days, args.metrics, args.seed), args.output)
+        print(f"Выгрузка сохранена: {args.output}")
+        return 0
+
+    if args.command == 'startup':
+        startup = measure_startup(max(args.startup_repeats, 1))
+        slow = [record['case'] for record in startup if not record['within_budget']]
+        if slow:
+            print(f"Дольше {STARTUP_BUDGET_SECONDS} с: {', '.join(slow)}", file=sys.stderr)
+        return 1 if slow else 0
+
+    metrics = [metric for metric in load_script().METRICS if metric in args.metrics]
+    with tempfile.TemporaryDirectory(prefix='wm_bench_') as temp_dir:
+        work_dir = args.work_dir or temp_dir
+        os.makedirs(work_dir, exist_ok=True)
+        startup = measure_startup(args.startup_repeats) if args.startup_repeats > 0 else []
+        records = []
+        for rows in args.rows:
+            records.extend(run_size(rows, args.days, metrics, args.seed, work_dir, not args.no_load, args.coloring))
+
+    report = {
+        'created': datetime.now().isoformat(timespec='seconds'),
+        'environment': environment(),
+        'parameters': {'days': args.days, 'metrics': metrics, 'seed': args.seed, 'coloring': args.coloring,
+                       'load': not args.no_load},
+        'stages': STAGES,
+        'startup_budget_seconds': STARTUP_BUDGET_SECONDS,
+        'startup': startup,
+        'results': records,
+    }
+    with open(args.output, 'w', encoding='utf-8') as f:
+        json.dump(report, f, ensure_ascii=False, indent=2)
+    print(f"Результаты сохранены: {args.output}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,22 @@
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import benchmark  # noqa: E402
+
+
+@pytest.fixture(scope='session')
+def wm():
+    """The analysis script loaded as a module."""
+    return benchmark.load_script()
+
+
+@pytest.fixture(scope='session')
+def export_path(tmp_path_factory):
+    """A small synthetic export with every metric over ten days."""
+    path = tmp_path_factory.mktemp('export') / 'export.xlsx'
+    benchmark.write_export(benchmark.generate_export(300, days=10, seed=1), str(path))
+    return str(path)
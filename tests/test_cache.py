@@ -0,0 +1,24 @@
+import shutil
+
+import pandas as pd
+import pytest
+
+
+def test_cache_dir_taken_by_file(wm, export_path, tmp_path):
+    pytest.importorskip('pyarrow')
+    input_path = str(tmp_path / 'export.xlsx')
+    shutil.copy(export_path, input_path)
+    (tmp_path / wm.CACHE_DIR).touch()
+
+    # Кэш недоступен, но выгрузка все равно читается
+    pd.testing.assert_frame_equal(wm.read_cached_export(input_path), wm.read_export(input_path))
+
+
+def test_cache_hit_matches_direct_read(wm, export_path, tmp_path):
+    pytest.importorskip('pyarrow')
+    input_path = str(tmp_path / 'export.xlsx')
+    shutil.copy(export_path, input_path)
+
+    first = wm.read_cached_export(input_path)
+    assert list((tmp_path / wm.CACHE_DIR).glob('*.arrow'))
+    pd.testing.assert_frame_equal(wm.read_cached_export(input_path), first)
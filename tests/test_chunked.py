@@ -0,0 +1,33 @@
+import pytest
+from openpyxl import load_workbook
+
+import benchmark
+
+
+def sheet_rows(path):
+    """Cell values and fill colors of every sheet, row by row."""
+    wb = load_workbook(path)
+    return {ws.title: [[(cell.value, cell.fill.fgColor.rgb if cell.fill.fill_type else None) for cell in row]
+                       for row in ws.iter_rows()]
+            for ws in wb.worksheets}
+
+
+def test_chunked_run_matches_full_run(wm, export_path, tmp_path):
+    outputs = {}
+    for chunk_size in (None, 37):
+        output_path = str(tmp_path / f"processed_{chunk_size}.xlsx")
+        # 300 строк по 37 — последний блок неполный; брендовые запросы исключаются в каждом блоке
+        wm.process_file(export_path, output_path, [], [], benchmark.BRAND_TERMS, False, False, True, False,
+                        write_only=True, cache_dir=None, chunk_size=chunk_size, progress=False, run_report=False)
+        outputs[chunk_size] = sheet_rows(output_path)
+
+    full, chunked = outputs[None], outputs[37]
+    assert list(chunked) == list(full)
+    for title, rows in full.items():
+        assert len(chunked[title]) == len(rows), title
+        for row, chunked_row in zip(rows, chunked[title]):
+            if row[0][0] == "Итого":
+                # Суммы блоков складываются в другом порядке, чем суммы всего столбца
+                assert [value for value, _ in chunked_row] == pytest.approx([value for value, _ in row])
+            else:
+                assert chunked_row == row, title
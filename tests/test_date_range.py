@@ -0,0 +1,17 @@
+import pytest
+
+
+@pytest.mark.parametrize('source', ['export', 'chunked', 'store'])
+def test_period_without_data_is_reported(wm, export_path, tmp_path, source):
+    input_path, options = export_path, {}
+    if source == 'chunked':
+        options['chunk_size'] = 50
+    elif source == 'store':
+        input_path = options['store_path'] = str(tmp_path / 'history.sqlite')
+        wm.ingest_export(input_path, export_path, cache_dir=None)
+
+    output_path = tmp_path / 'processed.xlsx'
+    with pytest.raises(ValueError, match="Нет данных по выбранным показателям"):
+        wm.process_file(input_path, str(output_path), [], [], [], False, False, False, False, date_from='2030-01-01',
+                        cache_dir=None, progress=False, run_report=False, **options)
+    assert not output_path.exists()
@@ -0,0 +1,79 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+
+def iterrows_dynamics(df, value_type):
+    """The original row-by-row dynamics, kept as the reference for the vectorized version."""
+    relevant_columns = [col for col in df.columns if col.endswith(f"_{value_type}")]
+    dynamics, differences, percent_changes, anomalies = [], [], [], []
+    for _, row in df.iterrows():
+        if len(relevant_columns) < 2:
+            dynamics.append("Нет данных")
+            differences.append(None)
+            percent_changes.append(None)
+            anomalies.append("Нет данных")
+            continue
+
+        row_start = row[relevant_columns[0]]
+        row_end = row[relevant_columns[-1]]
+        growth_count = 0
+        decline_count = 0
+        for i in range(len(relevant_columns) - 1):
+            current_value = row[relevant_columns[i]]
+            next_value = row[relevant_columns[i + 1]]
+            if next_value > current_value:
+                growth_count += 1
+            elif next_value < current_value:
+                decline_count += 1
+
+        difference = row_end - row_start if pd.notna(row_start) and pd.notna(row_end) else None
+        percent_change = (
+            round((difference / row_start) * 100, 2)
+            if row_start and pd.notna(difference) and row_start != 0
+            else None
+        )
+        anomalies.append(
+            "Аномалия" if pd.notna(difference) and abs(difference) > 2 * row[relevant_columns].mean() else "ОК")
+
+        if value_type in ['position', 'ctr'] and pd.notna(difference):
+            difference = round(difference)
+
+        if pd.notna(difference):
+            if row_end > row_start and growth_count > decline_count:
+                dynamics.append("Рост")
+            elif row_end < row_start:
+                dynamics.append("Падение")
+            else:
+                dynamics.append("Стабильно")
+        else:
+            dynamics.append("Нет данных")
+
+        differences.append(difference)
+        percent_changes.append(f"{percent_change}%" if percent_change is not None else None)
+    return dynamics, differences, percent_changes, anomalies
+
+
+def missing_as_none(values):
+    return [None if value is None or value != value else value for value in values]
+
+
+@pytest.mark.parametrize('value_type', ['shows', 'position'])
+@pytest.mark.parametrize('days', [1, 2, 9])
+@pytest.mark.parametrize('nan_share', [0.3, 0.7])
+def test_compute_dynamics_matches_iterrows(wm, value_type, days, nan_share):
+    rng = np.random.default_rng(days)
+    # Маленькие целые дают повторы и нули, доля пропусков — строки без начала, конца или вовсе без значений
+    values = rng.integers(0, 5, size=(400, days)).astype(float) * rng.choice([1, 0.5, 7.3], size=(400, days))
+    values[rng.random(values.shape) < nan_share] = np.nan
+    df = pd.DataFrame(values, columns=[f"2024-01-{day + 1:02d}_{value_type}" for day in range(days)])
+    df.insert(0, 'Query', [f"запрос {row}" for row in range(len(df))])
+    df.insert(1, 'Url', '/page/')
+
+    result = wm.calculate_dynamics_and_color(df, value_type)
+    dynamics, differences, percent_changes, anomalies = iterrows_dynamics(df, value_type)
+
+    assert result['Динамика изменений'].tolist() == dynamics
+    assert missing_as_none(result['Значение изменения'].tolist()) == missing_as_none(differences)
+    assert missing_as_none(result['Процентное изменение'].tolist()) == percent_changes
+    assert result['Аномалия'].tolist() == anomalies
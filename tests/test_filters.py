@@ -0,0 +1,12 @@
+import numpy as np
+
+
+def test_brand_filter_matches_substring_search(wm):
+    queries = ['Бренд магазин', 'купить brandname', 'просто запрос', 'brand', None, 'МАГАЗИН БРЕНД онлайн']
+    data = wm.encode_text_columns(wm.pd.DataFrame({'Query': queries, 'Url': ['/page/'] * len(queries)}))
+    vitals = ['бренд', 'brandname']
+
+    branded = wm.apply_filters(data, [], [], vitals, False, False, False, True)
+    expected = [isinstance(query, str) and any(term in query.lower() for term in vitals) for query in queries]
+    assert branded.index.tolist() == np.flatnonzero(expected).tolist()
+    assert not wm.apply_filters(data, [], [], vitals, False, False, True, False).index.isin(branded.index).any()
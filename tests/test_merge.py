@@ -0,0 +1,78 @@
+from datetime import date, timedelta
+
+import numpy as np
+import pandas as pd
+import pytest
+
+import benchmark
+
+METRICS = ['shows', 'clicks']
+
+
+@pytest.fixture(scope='module')
+def full():
+    """Ten days of a synthetic export; the overlapping windows below are cut from it."""
+    return benchmark.generate_export(120, days=10, metrics=METRICS, seed=7)
+
+
+def window(frame, first, last):
+    """Query, Url and the metric columns of the days first..last (1-based)."""
+    days = {(date(2024, 1, 1) + timedelta(days=day - 1)).isoformat() for day in range(first, last + 1)}
+    return frame[['Query', 'Url'] + [col for col in frame.columns[2:] if col.rpartition('_')[0] in days]].copy()
+
+
+def merge(wm, tmp_path, *frames):
+    paths = []
+    for number, frame in enumerate(frames):
+        paths.append(str(tmp_path / f"part{number}.xlsx"))
+        benchmark.write_export(frame, paths[-1])
+    merged = wm.merge_exports(paths, METRICS)
+    merged['Query'] = merged['Query'].astype(str)
+    merged['Url'] = merged['Url'].astype(str)
+    return merged.set_index(['Query', 'Url'])
+
+
+def test_later_window_wins_and_blanks_never_overwrite(wm, tmp_path, full):
+    early, late = window(full, 1, 7), window(full, 4, 10)
+    late_edit, early_edit, blank = (3, '2024-01-05_shows'), (8, '2024-01-06_clicks'), (12, '2024-01-04_shows')
+    late.loc[late_edit[0], late_edit[1]] = 1234.0
+    early.loc[early_edit[0], early_edit[1]] = 4321.0
+    late.loc[blank[0], blank[1]] = np.nan
+
+    # Поздний период выигрывает независимо от порядка файлов
+    merged = merge(wm, tmp_path, late, early)
+
+    expected = full.copy()
+    expected.loc[late_edit[0], late_edit[1]] = 1234.0
+    expected = expected.set_index(['Query', 'Url'])
+    pd.testing.assert_frame_equal(merged.loc[expected.index], expected, check_names=False)
+    assert len(merged) == len(full)
+
+    key = tuple(full.loc[early_edit[0], ['Query', 'Url']])
+    assert merged.loc[key, early_edit[1]] == full.loc[early_edit[0], early_edit[1]]
+    # Пустая ячейка позднего периода оставляет значение раннего
+    key = tuple(full.loc[blank[0], ['Query', 'Url']])
+    assert merged.loc[key, blank[1]] == full.loc[blank[0], blank[1]]
+
+
+def test_tie_goes_to_the_sheet_read_later(wm, tmp_path, full):
+    first, second = window(full, 1, 5), window(full, 1, 5)
+    second.loc[5, '2024-01-02_clicks'] = 77.0
+    key = tuple(full.loc[5, ['Query', 'Url']])
+
+    assert merge(wm, tmp_path, first, second).loc[key, '2024-01-02_clicks'] == 77.0
+    assert merge(wm, tmp_path, second, first).loc[key, '2024-01-02_clicks'] == full.loc[5, '2024-01-02_clicks']
+
+
+def test_repeated_row_keeps_its_last_value(wm, tmp_path, full):
+    sheet = window(full, 1, 5)
+    repeated = sheet.iloc[[10]].copy()
+    repeated['2024-01-03_shows'] = 555.0
+    repeated['2024-01-04_shows'] = np.nan
+    merged = merge(wm, tmp_path, pd.concat([sheet, repeated], ignore_index=True))
+
+    key = tuple(full.loc[10, ['Query', 'Url']])
+    assert len(merged) == len(sheet)
+    assert merged.loc[key, '2024-01-03_shows'] == 555.0
+    # Пустая ячейка повтора не затирает значение
+    assert merged.loc[key, '2024-01-04_shows'] == full.loc[10, '2024-01-04_shows']
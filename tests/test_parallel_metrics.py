@@ -0,0 +1,34 @@
+import pytest
+from openpyxl import load_workbook
+
+
+def workbook_contents(path):
+    """Sheet names, cell values and fills, conditional formatting rules and charts of a workbook."""
+    wb = load_workbook(path)
+    contents = []
+    for ws in wb.worksheets:
+        cells = [[(cell.value, cell.fill.fgColor.rgb if cell.fill.fill_type else None) for cell in row]
+                 for row in ws.iter_rows()]
+        rules = [(str(formatting.sqref), [(rule.formula, rule.stopIfTrue, rule.dxf.fill.bgColor.rgb)
+                                          for rule in formatting.rules])
+                 for formatting in ws.conditional_formatting]
+        charts = [(type(chart).__name__, chart.anchor._from.col, chart.anchor._from.row,
+                   [(series.val.numRef.f, series.cat.numRef.f) for series in chart.series])
+                  for chart in ws._charts]
+        contents.append((ws.title, cells, rules, charts))
+    return contents
+
+
+@pytest.mark.parametrize('coloring, total_formulas', [('fill', False), ('conditional', True)])
+def test_parallel_metrics_match_sequential(wm, export_path, tmp_path, coloring, total_formulas):
+    outputs = {}
+    for metric_workers in (None, 2):
+        output_path = str(tmp_path / f"processed_{metric_workers}.xlsx")
+        # Небольшой лимит строк делит каждую метрику на несколько листов
+        wm.process_file(export_path, output_path, [], [], [], False, False, False, False, write_only=True,
+                        coloring=coloring, cache_dir=None, max_rows_per_sheet=120, progress=False,
+                        metric_workers=metric_workers, total_formulas=total_formulas, run_report=False)
+        outputs[metric_workers] = workbook_contents(output_path)
+
+    assert len(outputs[None]) == 15
+    assert outputs[2] == outputs[None]
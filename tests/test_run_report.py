@@ -0,0 +1,31 @@
+import json
+import tracemalloc
+
+import pytest
+
+
+def test_memory_profile_without_traced_peak_reset(wm, export_path, tmp_path, monkeypatch):
+    # Python 3.8: tracemalloc.reset_peak еще нет
+    monkeypatch.delattr(tracemalloc, 'reset_peak')
+    output_path = tmp_path / 'processed.xlsx'
+    wm.process_file(export_path, str(output_path), [], [], [], False, False, False, False, metrics=['shows'],
+                    cache_dir=None, progress=False, memory_profile=True)
+
+    report = json.loads((tmp_path / 'processed_report.json').read_text(encoding='utf-8'))
+    assert report['status'] == 'ok'
+    assert report['memory']['traced_peak_per_stage'] is False
+    assert all(record['memory']['traced_peak_bytes'] > 0 for record in report['stages'])
+
+
+def test_interrupted_run_is_not_reported_ok(wm, export_path, tmp_path, monkeypatch):
+    def interrupt(*args, **kwargs):
+        raise KeyboardInterrupt
+
+    monkeypatch.setattr(wm, 'apply_filters', interrupt)
+    output_path = tmp_path / 'processed.xlsx'
+    with pytest.raises(KeyboardInterrupt):
+        wm.process_file(export_path, str(output_path), [], [], [], False, False, False, False, metrics=['shows'],
+                        cache_dir=None, progress=False)
+
+    report = json.loads((tmp_path / 'processed_report.json').read_text(encoding='utf-8'))
+    assert report['status'].startswith('error: KeyboardInterrupt')
@@ -0,0 +1,80 @@
+import shutil
+import sqlite3
+from contextlib import closing
+from datetime import date
+
+import numpy as np
+import pandas as pd
+import pytest
+
+import benchmark
+
+METRICS = ['shows', 'position']
+
+
+def day_columns(frame, first, last):
+    """Query, Url and the metric columns of the days first..last (1-based) of a generated export."""
+    days = {(date(2024, 1, 1) + pd.Timedelta(days=day - 1)).isoformat() for day in range(first, last + 1)}
+    return frame[['Query', 'Url'] + [col for col in frame.columns[2:] if col.rpartition('_')[0] in days]]
+
+
+def read_state(store_path):
+    with closing(sqlite3.connect(store_path)) as connection:
+        return pd.read_sql_query("SELECT * FROM dynamics_state ORDER BY metric, pair_id", connection)
+
+
+def rebuilt_state(wm, store_path, tmp_path):
+    """The dynamics state of a copy of the store, recomputed from its full history."""
+    copy_path = str(tmp_path / 'rebuilt.sqlite')
+    shutil.copy(store_path, copy_path)
+    with closing(sqlite3.connect(copy_path)) as connection, connection:
+        for metric in METRICS:
+            wm.update_dynamics_state(connection, metric, rebuild=True)
+    return read_state(copy_path)
+
+
+@pytest.fixture
+def ingest(wm, tmp_path, monkeypatch):
+    """Ingest export frames into one store, recording the rebuild flag of every state update."""
+    store_path = str(tmp_path / 'history.sqlite')
+    rebuilds = []
+    update = wm.update_dynamics_state
+
+    def spy(connection, metric, rebuild=False, changed_pairs=None):
+        rebuilds.append(rebuild)
+        return update(connection, metric, rebuild, changed_pairs)
+
+    monkeypatch.setattr(wm, 'update_dynamics_state', spy)
+
+    def run(frame, name):
+        rebuilds.clear()
+        path = str(tmp_path / name)
+        benchmark.write_export(frame, path)
+        wm.ingest_export(store_path, path, METRICS, cache_dir=None)
+        return list(rebuilds)
+
+    run.store_path = store_path
+    return run
+
+
+def test_overlapping_export_refolds_only_changed_pairs(wm, ingest, tmp_path):
+    history = benchmark.generate_export(200, days=14, metrics=METRICS, seed=3)
+    assert ingest(day_columns(history, 1, 10), 'first.xlsx') == [False, False]
+
+    # Следующая выгрузка повторяет дни 6-10, меняет в них несколько значений и добавляет новые пары
+    overlap = day_columns(history, 6, 14).copy()
+    overlap.iloc[[3, 50, 120], 2] += 1
+    overlap.iloc[7, 5] = np.nan
+    extra = day_columns(benchmark.generate_export(5, days=14, metrics=METRICS, seed=4), 6, 14).copy()
+    extra['Query'] = [f"новый запрос {index}" for index in range(len(extra))]
+    assert ingest(pd.concat([overlap, extra], ignore_index=True), 'second.xlsx') == [False, False]
+
+    pd.testing.assert_frame_equal(read_state(ingest.store_path), rebuilt_state(wm, ingest.store_path, tmp_path))
+
+
+def test_new_day_inside_folded_period_rebuilds(wm, ingest, tmp_path):
+    history = benchmark.generate_export(100, days=6, metrics=METRICS, seed=5)
+    ingest(history.drop(columns=[col for col in history.columns if col.startswith('2024-01-03')]), 'gap.xlsx')
+
+    assert ingest(day_columns(history, 3, 3), 'backfill.xlsx') == [True, True]
+    pd.testing.assert_frame_equal(read_state(ingest.store_path), rebuilt_state(wm, ingest.store_path, tmp_path))
@@ -1,13 +1,131 @@
+import argparse
+import glob
+import hashlib
+import importlib.util
+import json
+import multiprocessing
 import os
-import pandas as pd
-from tqdm import tqdm
-from openpyxl import Workbook
-from openpyxl.styles import PatternFill
-from openpyxl.chart import LineChart, Reference
-from openpyxl.utils import get_column_letter
-from openpyxl.chart import BarChart
-
+import posixpath
+import queue
 import re
+import sqlite3
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+import zipfile
+from collections import deque
+from contextlib import closing, contextmanager
+from itertools import islice
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from datetime import date, datetime
+from functools import lru_cache
+from xml.etree import ElementTree
+
+
+METRICS = ['shows', 'position', 'demand', 'ctr', 'clicks']
+
+EXCEL_MAX_ROWS = 1048576
+
+CACHE_DIR = '.wm_cache'
+CACHE_MAX_BYTES = 2 * 1024 ** 3
+CACHE_MAX_ENTRIES = 20
+
+BRAND_COLUMN = 'Бренд'
+
+# Периоды столбцов диаграммы и наибольшее число дней, при котором диаграмма еще строится по дням и по неделям
+CHART_PERIODS = ['day', 'week', 'month']
+CHART_DAILY_MAX_DAYS = 62
+CHART_WEEKLY_MAX_DAYS = 182
+CHART_PERIOD_NAMES = {'day': ('дням', 'Дни'), 'week': ('неделям', 'Недели'), 'month': ('месяцам', 'Месяцы')}
+
+# Хранилище истории: пары запрос/URL и значения метрик в длинном формате
+STORE_SCHEMA = """
+CREATE TABLE IF NOT EXISTS pairs (
+    id INTEGER PRIMARY KEY,
+    query TEXT NOT NULL,
+    url TEXT NOT NULL,
+    UNIQUE (query, url)
+);
+CREATE TABLE IF NOT EXISTS observations (
+    pair_id INTEGER NOT NULL REFERENCES pairs (id),
+    day TEXT NOT NULL,
+    metric TEXT NOT NULL,
+    value REAL NOT NULL,
+    PRIMARY KEY (metric, day, pair_id)
+) WITHOUT ROWID;
+CREATE VIEW IF NOT EXISTS metric_values AS
+    SELECT pairs.query, pairs.url, observations.day AS date, observations.metric, observations.value
+    FROM observations JOIN pairs ON pairs.id = observations.pair_id;
+CREATE TABLE IF NOT EXISTS dynamics_state (
+    metric TEXT NOT NULL,
+    pair_id INTEGER NOT NULL REFERENCES pairs (id),
+    first_value REAL,
+    last_value REAL,
+    growth INTEGER NOT NULL,
+    decline INTEGER NOT NULL,
+    value_sum REAL NOT NULL,
+    value_count INTEGER NOT NULL,
+    PRIMARY KEY (metric, pair_id)
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS dynamics_days (
+    metric TEXT PRIMARY KEY,
+    last_day TEXT NOT NULL,
+    days INTEGER NOT NULL
+);
+"""
+
+# Форматы таблиц результатов и расширения их файлов
+TABLE_FORMATS = {'parquet': '.parquet', 'feather': '.feather', 'csv': '.csv'}
+
+# Сколько готовых листов может ждать записи в очереди фонового писателя. Одного достаточно, чтобы расчет
+# и запись шли одновременно; каждый следующий добавляет к пиковой памяти еще один лист на больших выгрузках
+WRITER_QUEUE_SIZE = 1
+
+PACKAGE_REL_NS = "http://schemas.openxmlformats.org/package/2006/relationships"
+OFFICE_REL_NS = "http://schemas.openxmlformats.org/officeDocument/2006/relationships"
+SPREADSHEET_NS = "http://schemas.openxmlformats.org/spreadsheetml/2006/main"
+CONTENT_TYPES_NS = "http://schemas.openxmlformats.org/package/2006/content-types"
+WORKSHEET_REL_TYPE = "http://schemas.openxmlformats.org/officeDocument/2006/relationships/worksheet"
+
+
+def lazy_import(name):
+    """Return the module *name*, deferring its execution to the first attribute access."""
+    if name in sys.modules:
+        return sys.modules[name]
+    spec = importlib.util.find_spec(name)
+    if spec is None:
+        raise ModuleNotFoundError(f"No module named {name!r}", name=name)
+    loader = importlib.util.LazyLoader(spec.loader)
+    spec.loader = loader
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[name] = module
+    loader.exec_module(module)
+    return module
+
+
+# numpy и pandas загружаются при первом обращении, чтобы справка, список файлов
+# и проверка аргументов не ждали их импорта; openpyxl и tqdm импортируются в функциях
+np = lazy_import('numpy')
+pd = lazy_import('pandas')
+
+# Данные, доступные процессам параллельного расчета показателей
+_METRIC_WORKER_DATA = None
+
+# Скомпилированные автоматы брендовых запросов, по ключу (движок, хэш vital.txt)
+_BRAND_MATCHERS = {}
+
+GROWTH_COLOR, DECLINE_COLOR, STABLE_COLOR = "00FF00", "FF0000", "FFFF00"
+
+
+@lru_cache(maxsize=None)
+def day_fills():
+    """Return the shared (growth, decline, stable) fills used to colour day cells."""
+    from openpyxl.styles import PatternFill
+
+    return tuple(PatternFill(start_color=color, fill_type="solid")
+                 for color in (GROWTH_COLOR, DECLINE_COLOR, STABLE_COLOR))
 
 
 def get_yes_no_input(prompt):
@@ -27,198 +145,1952 @@ def load_filter_file(file_name):
     return []
 
 
+def to_date(value):
+    """Convert an ISO date string (or a date) to datetime.date; None stays None."""
+    if value is None or isinstance(value, date):
+        return value
+    return date.fromisoformat(str(value)[:10])
+
+
+def in_date_range(column_date, date_from=None, date_to=None):
+    """Check whether a column date prefix falls into the selected date range."""
+    if date_from is None and date_to is None:
+        return True
+    try:
+        day = to_date(column_date)
+    except ValueError:
+        return False
+    return (date_from is None or day >= to_date(date_from)) and (date_to is None or day <= to_date(date_to))
+
+
+def select_columns(columns, metrics=METRICS, date_from=None, date_to=None):
+    """Pick Query, Url and the `<date>_<metric>` columns needed for the selected metrics and date range."""
+    selected = []
+    for col in columns:
+        if col in ('Query', 'Url'):
+            selected.append(col)
+            continue
+        column_date, separator, metric = str(col).rpartition('_')
+        if separator and metric in metrics and in_date_range(column_date, date_from, date_to):
+            selected.append(col)
+    return selected
+
+
+def read_header(input_path):
+    """Read only the header row of the first sheet; returns None when the format has no streaming reader."""
+    if not str(input_path).lower().endswith('.xlsx'):
+        return None
+    from openpyxl import load_workbook
+
+    wb = load_workbook(input_path, read_only=True)
+    try:
+        header = next(wb.worksheets[0].iter_rows(min_row=1, max_row=1, values_only=True), ())
+    finally:
+        wb.close()
+    return [col for col in header if col is not None]
+
+
+def encode_text_columns(df):
+    """Dictionary-encode the Query and Url columns as categoricals."""
+    return df.astype({col: 'category' for col in ('Query', 'Url') if col in df.columns})
+
+
+def text_codes(column):
+    """Return integer codes (-1 for missing values) and the distinct values of a text column."""
+    if isinstance(column.dtype, pd.CategoricalDtype):
+        return column.cat.codes.to_numpy(), column.cat.categories
+    return pd.factorize(column)
+
+
+def isin_codes(column, values):
+    """Test membership of a text column against values using its integer codes."""
+    codes, uniques = text_codes(column)
+    allowed = pd.Index(uniques).get_indexer(pd.Index(values).unique())
+    # Последний элемент таблицы соответствует коду -1 (пустое значение)
+    lookup = np.zeros(len(uniques) + 1, dtype=bool)
+    lookup[allowed[allowed >= 0]] = True
+    return lookup[codes]
+
+
+def calamine_available():
+    """Whether exports can be read with python-calamine: it must be installed and pandas must be 2.2 or newer."""
+    if importlib.util.find_spec('python_calamine') is None:
+        return False
+    # engine='calamine' появился в pandas 2.2; более старые версии отвечают ValueError
+    version = re.match(r'(\d+)\.(\d+)', pd.__version__)
+    return version is not None and tuple(map(int, version.groups())) >= (2, 2)
+
+
+def read_export(input_path, metrics=METRICS, date_from=None, date_to=None):
+    """Load the first sheet of an export, reading only the columns needed for the analysis."""
+    header = read_header(input_path)
+    if header is None:
+        excel_data = pd.ExcelFile(input_path)
+        data = excel_data.parse(excel_data.sheet_names[0])
+        return encode_text_columns(data[select_columns(data.columns, metrics, date_from, date_to)])
+
+    usecols = select_columns(header, metrics, date_from, date_to)
+
+    # Быстрый колоночный ридер, если установлен python-calamine; иначе прежний путь через openpyxl
+    if calamine_available():
+        data = pd.read_excel(input_path, sheet_name=0, usecols=usecols, engine='calamine')
+    else:
+        excel_data = pd.ExcelFile(input_path)
+        data = excel_data.parse(excel_data.sheet_names[0], usecols=usecols)
+    return encode_text_columns(data)
+
+
+def iter_export_chunks(input_path, chunk_size, metrics=METRICS, date_from=None, date_to=None):
+    """Stream the first sheet of an .xlsx export as DataFrames of at most chunk_size rows."""
+    from openpyxl import load_workbook
+
+    wb = load_workbook(input_path, read_only=True)
+    try:
+        rows = wb.worksheets[0].iter_rows(values_only=True)
+        header = list(next(rows, ()))
+        usecols = select_columns([col for col in header if col is not None], metrics, date_from, date_to)
+        positions = [header.index(col) for col in usecols]
+
+        block = []
+        for row in rows:
+            if all(value is None for value in row):
+                continue
+            block.append([row[position] if position < len(row) else None for position in positions])
+            if len(block) == chunk_size:
+                yield encode_text_columns(pd.DataFrame(block, columns=usecols))
+                block = []
+        if block:
+            yield encode_text_columns(pd.DataFrame(block, columns=usecols))
+    finally:
+        wb.close()
+
+
+def iter_sheet_rows(input_path):
+    """Yield the rows of every sheet of an export, header first, as tuples of cell values."""
+    if str(input_path).lower().endswith('.xlsx'):
+        from openpyxl import load_workbook
+
+        wb = load_workbook(input_path, read_only=True)
+        try:
+            for ws in wb.worksheets:
+                yield ws.iter_rows(values_only=True)
+        finally:
+            wb.close()
+        return
+
+    # Старый формат .xls потоково не читается
+    for sheet in pd.read_excel(input_path, sheet_name=None, header=None).values():
+        yield sheet.astype(object).where(sheet.notna(), None).itertuples(index=False, name=None)
+
+
+def merge_exports(input_paths, metrics=METRICS, date_from=None, date_to=None, block_size=10000):
+    """Merge every sheet of several exports into one export-shaped table on a common date axis.
+
+    Rows are hash-joined on (Query, Url) and `<date>_<metric>` columns are aligned by name, filling one
+    rows x columns matrix directly. Where sheets overlap, the value of the sheet whose date window ends
+    later wins, ties going to the sheet read later; empty cells never overwrite values.
+    """
+    row_index = {}
+    column_index = {}
+    sources = []
+    for input_path in input_paths:
+        for rows in iter_sheet_rows(input_path):
+            header = list(next(rows, ()))
+            if 'Query' not in header or 'Url' not in header:
+                continue
+            columns = [col for col in select_columns([col for col in header if col is not None], metrics, date_from,
+                                                      date_to) if col not in ('Query', 'Url')]
+            if not columns:
+                continue
+            query_position, url_position = header.index('Query'), header.index('Url')
+            positions = [header.index(col) for col in columns]
+            column_ids = np.array([column_index.setdefault(col, len(column_index)) for col in columns])
+
+            # Значения собираются блоками в координатном виде: строка, столбец, значение
+            row_parts, column_parts, value_parts = [], [], []
+            while True:
+                block = [row for row in islice(rows, block_size) if any(value is not None for value in row)]
+                if not block:
+                    break
+                row_ids = np.array([row_index.setdefault((row[query_position], row[url_position]), len(row_index))
+                                    for row in block])
+                values = np.array([[row[position] if position < len(row) else None for position in positions]
+                                   for row in block], dtype=float)
+                block_rows, block_columns = np.nonzero(~np.isnan(values))
+                row_parts.append(row_ids[block_rows])
+                column_parts.append(column_ids[block_columns])
+                value_parts.append(values[block_rows, block_columns])
+            if row_parts:
+                window_end = max(str(col).rpartition('_')[0] for col in columns)
+                sources.append((window_end, len(sources), np.concatenate(row_parts), np.concatenate(column_parts),
+                                np.concatenate(value_parts)))
+
+    # Общая ось: дни по порядку, внутри дня показатели в порядке METRICS
+    names = sorted(column_index, key=lambda col: (str(col).rpartition('_')[0], METRICS.index(col.rpartition('_')[2])))
+    position_of = np.empty(len(names), dtype=np.int64)
+    position_of[[column_index[name] for name in names]] = np.arange(len(names))
+
+    wide = np.full((len(row_index), len(names)), np.nan)
+    for _, _, row_ids, column_ids, values in sorted(sources, key=lambda source: source[:2]):
+        cells = row_ids * len(names) + position_of[column_ids]
+        # Повторы строки внутри одного листа: остается последнее значение
+        last = len(cells) - 1 - np.unique(cells[::-1], return_index=True)[1]
+        wide.flat[cells[last]] = values[last]
+
+    data = pd.DataFrame(wide, columns=names)
+    keys = list(row_index)
+    data.insert(0, 'Query', [query for query, _ in keys])
+    data.insert(1, 'Url', [url for _, url in keys])
+    return encode_text_columns(data)
+
+
+def file_fingerprint(path):
+    """Build a cache key from the file's content hash, size and modification time."""
+    stat = os.stat(path)
+    digest = hashlib.blake2b(digest_size=16)
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            digest.update(block)
+    return f"{digest.hexdigest()}_{stat.st_size}_{stat.st_mtime_ns}"
+
+
+def resolve_cache_dir(input_path, cache_dir):
+    """Resolve a relative cache directory next to the input file; None stays None."""
+    if cache_dir is None:
+        return None
+    return os.path.join(os.path.dirname(os.path.abspath(input_path)), cache_dir)
+
+
+def evict_cache(cache_dir, max_bytes=CACHE_MAX_BYTES, max_entries=CACHE_MAX_ENTRIES):
+    """Drop the least recently used cache entries beyond the size and count limits."""
+    entries = []
+    for name in os.listdir(cache_dir):
+        if name.endswith('.arrow'):
+            path = os.path.join(cache_dir, name)
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, path))
+
+    total = 0
+    for index, (_, size, path) in enumerate(sorted(entries, reverse=True)):
+        total += size
+        if index >= max_entries or total > max_bytes:
+            # Запись могла уже удалить параллельно работающая обработка другого файла
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+
+def read_cached_export(input_path, cache_dir=CACHE_DIR, metrics=METRICS, date_from=None, date_to=None):
+    """Load an export through an Arrow sidecar cache of its parsed first sheet.
+
+    The cache lives in cache_dir (relative paths are resolved next to the input file) and is memory-mapped on
+    later runs. Without pyarrow, or with cache_dir=None, the export is read directly.
+    """
+    if cache_dir is None or importlib.util.find_spec('pyarrow') is None:
+        return read_export(input_path, metrics, date_from, date_to)
+
+    import pyarrow as pa
+    from pyarrow import feather
+
+    cache_dir = resolve_cache_dir(input_path, cache_dir)
+    cache_path = os.path.join(cache_dir, f"{file_fingerprint(input_path)}.arrow")
+
+    if os.path.exists(cache_path):
+        # Обновляем время доступа для вытеснения давно не использованных записей (в папке только для чтения
+        # запись остается без обновления)
+        try:
+            os.utime(cache_path)
+        except OSError:
+            pass
+        with pa.memory_map(cache_path) as source:
+            columns = pa.ipc.open_file(source).schema.names
+        usecols = select_columns(columns, metrics, date_from, date_to)
+        return encode_text_columns(feather.read_table(cache_path, columns=usecols, memory_map=True).to_pandas())
+
+    # Кэшируем все столбцы метрик, чтобы повторные запуски с другими настройками тоже попадали в кэш
+    # Недоступная для записи папка (или файл на месте папки кэша) означает работу без кэша
+    data = read_export(input_path)
+    temp_path = f"{cache_path}.{os.getpid()}.tmp"
+    try:
+        os.makedirs(cache_dir, exist_ok=True)
+        feather.write_feather(data, temp_path, compression='uncompressed')
+        os.replace(temp_path, cache_path)
+    except (pa.ArrowException, OSError):
+        try:
+            os.remove(temp_path)
+        except OSError:
+            pass
+    else:
+        evict_cache(cache_dir)
+
+    return data[select_columns(data.columns, metrics, date_from, date_to)]
+
+
+def open_store(store_path):
+    """Open (and create if needed) the SQLite history store."""
+    connection = sqlite3.connect(store_path)
+    connection.execute("PRAGMA journal_mode=WAL")
+    connection.execute("PRAGMA synchronous=NORMAL")
+    connection.executescript(STORE_SCHEMA)
+    return connection
+
+
+def ingest_export(store_path, input_path, metrics=METRICS, cache_dir=CACHE_DIR):
+    """Load an export into the history store and return the number of values written.
+
+    Values of days already in the store are replaced by the newer export; empty cells never
+    overwrite stored values. The running dynamics state is then extended with the new days only.
+    Pairs with new or changed values on already folded days are re-folded from the stored history;
+    the whole metric is rebuilt only when a day missing from the store lands inside the folded period.
+    """
+    metrics = [metric for metric in METRICS if metric in metrics]
+    data = read_cached_export(input_path, resolve_cache_dir(input_path, cache_dir), metrics)
+    cube = build_metric_cube(data, metrics)
+    queries = data['Query'].astype(object).fillna('').astype(str).tolist()
+    urls = data['Url'].astype(object).fillna('').astype(str).tolist()
+    del data
+
+    written = 0
+    with closing(open_store(store_path)) as connection, connection:
+        # Идентификаторы пар находим одним соединением с временной таблицей строк выгрузки
+        connection.execute("CREATE TEMP TABLE export_rows (row INTEGER PRIMARY KEY, query TEXT, url TEXT)")
+        connection.executemany("INSERT INTO export_rows VALUES (?, ?, ?)", zip(range(len(queries)), queries, urls))
+        connection.execute("INSERT OR IGNORE INTO pairs (query, url) SELECT query, url FROM export_rows")
+        pair_ids = np.zeros(len(queries), dtype=np.int64)
+        for row, pair_id in connection.execute(
+                "SELECT export_rows.row, pairs.id FROM export_rows JOIN pairs USING (query, url)"):
+            pair_ids[row] = pair_id
+        connection.execute("DROP TABLE export_rows")
+
+        folded_until = dict(connection.execute("SELECT metric, last_day FROM dynamics_days"))
+        stale = set()
+        changed = {}
+        for metric_idx, metric in enumerate(cube['metrics']):
+            for date_idx in np.flatnonzero(cube['present'][metric_idx]):
+                values = cube['values'][metric_idx, :, date_idx]
+                filled = ~np.isnan(values)
+                # Дни хранятся в ISO-формате, чтобы выборка по диапазону дат работала сравнением строк
+                day = cube['dates'][date_idx]
+                try:
+                    day = to_date(day).isoformat()
+                except ValueError:
+                    pass
+                if filled.any() and metric in folded_until and day <= folded_until[metric] and metric not in stale:
+                    stored = dict(connection.execute(
+                        "SELECT pair_id, value FROM observations WHERE metric = ? AND day = ?", (metric, day)))
+                    if not stored:
+                        # Новый день внутри учтенного периода сдвигает ряд дней всех пар
+                        stale.add(metric)
+                    else:
+                        # В уже учтенном дне пересчитываются только пары с новыми или измененными значениями
+                        changed.setdefault(metric, set()).update(
+                            pair_id for pair_id, value in zip(pair_ids[filled].tolist(), values[filled].tolist())
+                            if stored.get(pair_id) != value)
+                connection.executemany(
+                    "INSERT INTO observations VALUES (?, ?, ?, ?) "
+                    "ON CONFLICT (metric, day, pair_id) DO UPDATE SET value = excluded.value "
+                    "WHERE observations.value != excluded.value",
+                    ((pair_id, day, metric, value)
+                     for pair_id, value in zip(pair_ids[filled].tolist(), values[filled].tolist())))
+                written += int(filled.sum())
+
+        for metric_idx, metric in enumerate(cube['metrics']):
+            if cube['present'][metric_idx].any():
+                update_dynamics_state(connection, metric, rebuild=metric in stale, changed_pairs=changed.get(metric))
+    return written
+
+
+def update_dynamics_state(connection, metric, rebuild=False, changed_pairs=None):
+    """Fold the days stored after the last folded one into the persisted per-(pair, metric) dynamics state.
+
+    changed_pairs holds pairs whose values on already folded days changed; their state is recomputed from the
+    stored history first. rebuild=True recomputes the state of every pair.
+    """
+    folded = connection.execute("SELECT last_day, days FROM dynamics_days WHERE metric = ?", (metric,)).fetchone()
+    if folded is not None and not rebuild and changed_pairs:
+        rebuild = not refold_dynamics_state(connection, metric, sorted(changed_pairs), *folded)
+    if rebuild or folded is None:
+        connection.execute("DELETE FROM dynamics_state WHERE metric = ?", (metric,))
+        folded = ('', 0)
+    last_day, days = folded
+
+    observations = pd.read_sql_query("SELECT pair_id, day, value FROM observations WHERE metric = ? AND day > ?",
+                                     connection, params=(metric, last_day))
+    if observations.empty:
+        return
+    stored = pd.read_sql_query(
+        "SELECT pair_id, first_value, last_value, growth, decline, value_sum, value_count "
+        "FROM dynamics_state WHERE metric = ?", connection, params=(metric,), index_col='pair_id')
+
+    pair_ids = np.union1d(stored.index.to_numpy(), observations['pair_id'].unique())
+    state = stored_dynamics_state(stored, pair_ids, days)
+
+    new_days, cols = np.unique(observations['day'].to_numpy(), return_inverse=True)
+    values = np.full((len(pair_ids), len(new_days)), np.nan)
+    values[np.searchsorted(pair_ids, observations['pair_id'].to_numpy()), cols] = observations['value'].to_numpy()
+    state = extend_dynamics_state(state, values)
+    write_dynamics_state(connection, metric, pair_ids, state)
+    connection.execute("INSERT OR REPLACE INTO dynamics_days VALUES (?, ?, ?)",
+                       (metric, str(new_days[-1]), state['days']))
+
+
+def refold_dynamics_state(connection, metric, pair_ids, last_day, days):
+    """Recompute the persisted state of the given pairs over the folded days, up to and including last_day.
+
+    Only the history of these pairs is read. Returns False when the stored days no longer match the folded
+    ones, in which case the whole metric has to be rebuilt.
+    """
+    # Учтенные дни перебираются поиском по индексу наблюдений, без чтения их значений
+    folded_days = [day for (day,) in connection.execute(
+        "WITH RECURSIVE folded_days (day) AS ("
+        " SELECT MIN(day) FROM observations WHERE metric = :metric"
+        " UNION ALL"
+        " SELECT (SELECT MIN(day) FROM observations WHERE metric = :metric AND day > folded_days.day)"
+        " FROM folded_days WHERE folded_days.day < :last_day"
+        ") SELECT day FROM folded_days WHERE day <= :last_day",
+        {'metric': metric, 'last_day': last_day})]
+    if len(folded_days) != days:
+        return False
+
+    connection.execute("CREATE TEMP TABLE refold_days (position INTEGER PRIMARY KEY, day TEXT)")
+    connection.execute("CREATE TEMP TABLE refold_pairs (pair_id INTEGER PRIMARY KEY)")
+    try:
+        connection.executemany("INSERT INTO refold_days VALUES (?, ?)", enumerate(folded_days))
+        connection.executemany("INSERT INTO refold_pairs VALUES (?)", ((pair_id,) for pair_id in pair_ids))
+        # Каждое значение находится по первичному ключу (метрика, день, пара)
+        observations = pd.read_sql_query(
+            "SELECT refold_pairs.pair_id, refold_days.position, observations.value "
+            "FROM refold_days CROSS JOIN refold_pairs JOIN observations ON observations.metric = ? "
+            "AND observations.day = refold_days.day AND observations.pair_id = refold_pairs.pair_id",
+            connection, params=(metric,))
+    finally:
+        connection.execute("DROP TABLE refold_days")
+        connection.execute("DROP TABLE refold_pairs")
+
+    pair_ids = np.asarray(pair_ids, dtype=np.int64)
+    values = np.full((len(pair_ids), days), np.nan)
+    values[np.searchsorted(pair_ids, observations['pair_id'].to_numpy()),
+           observations['position'].to_numpy()] = observations['value'].to_numpy()
+    write_dynamics_state(connection, metric, pair_ids,
+                         extend_dynamics_state(empty_dynamics_state(len(pair_ids)), values))
+    return True
+
+
+def write_dynamics_state(connection, metric, pair_ids, state):
+    """Persist the running dynamics state of the given pairs, replacing their previous rows."""
+    def nullable(array):
+        return [None if value != value else value for value in array.tolist()]
+
+    connection.executemany(
+        "INSERT OR REPLACE INTO dynamics_state VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+        zip([metric] * len(pair_ids), pair_ids.tolist(), nullable(state['first']), nullable(state['last']),
+            state['growth'].tolist(), state['decline'].tolist(), state['sum'].tolist(), state['count'].tolist()))
+
+
+def read_store_dynamics(store_path, metric, pair_ids):
+    """Return the persisted dynamics of a metric for the given pairs, covering every stored day."""
+    with closing(sqlite3.connect(store_path)) as connection:
+        days = connection.execute("SELECT days FROM dynamics_days WHERE metric = ?", (metric,)).fetchone()
+        stored = pd.read_sql_query(
+            "SELECT pair_id, first_value, last_value, growth, decline, value_sum, value_count "
+            "FROM dynamics_state WHERE metric = ?", connection, params=(metric,), index_col='pair_id')
+    return dynamics_from_state(stored_dynamics_state(stored, pair_ids, days[0] if days else 0), metric)
+
+
+def stored_dynamics_state(stored, pair_ids, days):
+    """Turn dynamics_state rows into a running state aligned to pair_ids.
+
+    Pairs without a stored row have had no values of the metric so far.
+    """
+    stored = stored.reindex(pair_ids)
+    return {
+        'days': days,
+        'first': stored['first_value'].to_numpy(dtype=float, na_value=np.nan),
+        'last': stored['last_value'].to_numpy(dtype=float, na_value=np.nan),
+        'growth': stored['growth'].fillna(0).to_numpy(dtype=np.int64),
+        'decline': stored['decline'].fillna(0).to_numpy(dtype=np.int64),
+        'sum': stored['value_sum'].fillna(0).to_numpy(dtype=float),
+        'count': stored['value_count'].fillna(0).to_numpy(dtype=np.int64),
+    }
+
+
+def read_store(store_path, metrics=METRICS, date_from=None, date_to=None):
+    """Read the stored history for date_from..date_to as an export-shaped table (Query, Url, `<date>_<metric>`)."""
+    if not os.path.exists(store_path):
+        raise FileNotFoundError(store_path)
+    conditions = [f"metric IN ({', '.join('?' * len(metrics))})"]
+    params = list(metrics)
+    if date_from is not None:
+        conditions.append("day >= ?")
+        params.append(to_date(date_from).isoformat())
+    if date_to is not None:
+        conditions.append("day <= ?")
+        params.append(to_date(date_to).isoformat())
+
+    with closing(sqlite3.connect(store_path)) as connection:
+        observations = pd.read_sql_query(
+            f"SELECT pair_id, day, metric, value FROM observations WHERE {' AND '.join(conditions)}",
+            connection, params=params)
+        pairs = pd.read_sql_query("SELECT id, query, url FROM pairs", connection, index_col='id')
+
+    # Разворачиваем длинную таблицу в матрицу пар x столбцов выгрузки
+    pair_ids, rows = np.unique(observations['pair_id'].to_numpy(), return_inverse=True)
+    keys = sorted(set(zip(observations['day'], observations['metric'])),
+                  key=lambda key: (key[0], METRICS.index(key[1])))
+    key_index = {key: position for position, key in enumerate(keys)}
+    cols = np.fromiter((key_index[key] for key in zip(observations['day'], observations['metric'])),
+                       dtype=np.int64, count=len(observations))
+    wide = np.full((len(pair_ids), len(keys)), np.nan)
+    wide[rows, cols] = observations['value'].to_numpy()
+
+    # Индекс строк — идентификатор пары в хранилище
+    data = pd.DataFrame(wide, columns=[f"{day}_{metric}" for day, metric in keys], index=pair_ids)
+    pairs = pairs.loc[pair_ids]
+    data.insert(0, 'Query', pairs['query'].to_numpy())
+    data.insert(1, 'Url', pairs['url'].to_numpy())
+    return encode_text_columns(data)
+
+
+def build_brand_automaton(terms):
+    """Build an Aho-Corasick automaton over the lowercased terms as (goto, fail, output) lists."""
+    goto, fail, output = [{}], [0], [False]
+    for term in terms:
+        state = 0
+        for char in term.lower():
+            next_state = goto[state].get(char)
+            if next_state is None:
+                next_state = len(goto)
+                goto.append({})
+                fail.append(0)
+                output.append(False)
+                goto[state][char] = next_state
+            state = next_state
+        output[state] = True
+
+    # Суффиксные ссылки строим обходом в ширину; признак совпадения наследуется по ним
+    queue = deque(goto[0].values())
+    while queue:
+        state = queue.popleft()
+        for char, next_state in goto[state].items():
+            queue.append(next_state)
+            fallback = fail[state]
+            while fallback and char not in goto[fallback]:
+                fallback = fail[fallback]
+            fail[next_state] = goto[fallback].get(char, 0)
+            output[next_state] = output[next_state] or output[fail[next_state]]
+
+    return goto, fail, output
+
+
+def automaton_matches(automaton, text):
+    """Check whether the text contains any term of the automaton, in time linear in the text length."""
+    goto, fail, output = automaton
+    if output[0]:
+        return True
+    state = 0
+    for char in text.lower():
+        while state and char not in goto[state]:
+            state = fail[state]
+        state = goto[state].get(char, 0)
+        if output[state]:
+            return True
+    return False
+
+
+def load_brand_matcher(vitals):
+    """Return a predicate telling whether a query contains any vital term.
+
+    Uses pyahocorasick when installed and the pure Python automaton otherwise. The compiled automaton is kept for
+    the process lifetime, so every chunk of a run reuses it.
+    """
+    key = hashlib.blake2b('\n'.join(vitals).encode('utf-8'), digest_size=16).hexdigest()
+    backend = 'pyahocorasick' if importlib.util.find_spec('ahocorasick') is not None else 'python'
+    if (backend, key) in _BRAND_MATCHERS:
+        return _BRAND_MATCHERS[(backend, key)]
+
+    # Сборка занимает десятки миллисекунд даже на тысячах терминов, поэтому на диск автомат не сохраняется
+    if backend == 'pyahocorasick':
+        import ahocorasick
+        automaton = ahocorasick.Automaton()
+        for term in vitals:
+            automaton.add_word(term.lower(), True)
+        automaton.make_automaton()
+
+        def matches(text):
+            return next(automaton.iter(text.lower()), None) is not None
+    else:
+        automaton = build_brand_automaton(vitals)
+
+        def matches(text):
+            return automaton_matches(automaton, text)
+
+    _BRAND_MATCHERS[(backend, key)] = matches
+    return matches
+
+
+def brand_mask(queries, matches):
+    """Return a boolean mask of queries containing a vital term; non-string queries never match."""
+    return np.fromiter((isinstance(query, str) and matches(query) for query in queries), dtype=bool,
+                       count=len(queries))
+
+
+def add_brand_column(df, vitals):
+    """Classify each unique query once and store the result as a boolean brand column."""
+    matches = load_brand_matcher(vitals)
+    queries = df['Query']
+    if isinstance(queries.dtype, pd.CategoricalDtype):
+        # Проверяем только запросы, оставшиеся после предыдущих фильтров
+        queries = queries.cat.remove_unused_categories()
+    codes, uniques = text_codes(queries)
+    # Код -1 (пустой запрос) попадает на добавленный в конец False
+    unique_mask = np.append(brand_mask(uniques, matches), False)
+    return df.assign(**{BRAND_COLUMN: unique_mask[codes]})
+
+
 def apply_filters(df, urls, keywords, vitals, use_urls, use_keywords, use_vitals, analyze_only_brand):
     """Apply filters to the DataFrame."""
     # Фильтр по URL
     if use_urls and urls:
-        df = df[df['Url'].isin(urls)]
+        df = df[isin_codes(df['Url'], urls)]
 
     # Фильтр по ключевым словам
     if use_keywords and keywords:
-        df = df[df['Query'].isin(keywords)]
+        df = df[isin_codes(df['Query'], keywords)]
+
+    # Признак бренда считается один раз и используется обоими режимами
+    if (use_vitals or analyze_only_brand) and vitals and BRAND_COLUMN not in df.columns:
+        df = add_brand_column(df, vitals)
 
     # Фильтр по витальным ключам (вхождение)
     if use_vitals and vitals:
-        df = df[~df['Query'].str.contains('|'.join(map(re.escape, vitals)), case=False, na=False)]
+        df = df[~df[BRAND_COLUMN]]
 
     # Анализ только брендовых запросов
     if analyze_only_brand and vitals:
-        df = df[df['Query'].str.contains('|'.join(map(re.escape, vitals)), case=False, na=False)]
+        df = df[df[BRAND_COLUMN]]
 
     return df
 
 
+def empty_dynamics_state(rows_count):
+    """Return the running dynamics state of rows that have no days yet."""
+    return {
+        'days': 0,
+        'first': np.full(rows_count, np.nan),
+        'last': np.full(rows_count, np.nan),
+        'growth': np.zeros(rows_count, dtype=np.int64),
+        'decline': np.zeros(rows_count, dtype=np.int64),
+        'sum': np.zeros(rows_count),
+        'count': np.zeros(rows_count, dtype=np.int64),
+    }
+
+
+def extend_dynamics_state(state, values):
+    """Fold the next day columns (a rows x new days matrix) into a running dynamics state.
+
+    Only the new columns and the previous last value are touched, so adding N days costs O(rows x N).
+    """
+    values = np.asarray(values, dtype=float)
+    if not values.shape[1]:
+        return state
+    # Сравнение первого нового дня идет с последним известным значением
+    chain = values if not state['days'] else np.column_stack([state['last'], values])
+    valid = ~np.isnan(values)
+    return {
+        'days': state['days'] + values.shape[1],
+        'first': values[:, 0] if not state['days'] else state['first'],
+        'last': values[:, -1],
+        # Сравнения с NaN дают False, как и в построчном варианте
+        'growth': state['growth'] + np.count_nonzero(chain[:, 1:] > chain[:, :-1], axis=1),
+        'decline': state['decline'] + np.count_nonzero(chain[:, 1:] < chain[:, :-1], axis=1),
+        'sum': state['sum'] + np.where(valid, values, 0).sum(axis=1),
+        'count': state['count'] + valid.sum(axis=1),
+    }
+
+
+def compute_dynamics(values, value_type):
+    """Compute dynamics, differences, percent changes and anomalies for a rows x days matrix."""
+    values = np.asarray(values, dtype=float)
+    return dynamics_from_state(extend_dynamics_state(empty_dynamics_state(values.shape[0]), values), value_type)
+
+
+def dynamics_from_state(state, value_type):
+    """Compute dynamics, differences, percent changes and anomalies from a running dynamics state."""
+    rows_count = len(state['last'])
+
+    # Если данных недостаточно для анализа, заполняем None
+    if state['days'] < 2:
+        return {
+            'dynamics': np.full(rows_count, "Нет данных", dtype=object),
+            'difference': np.full(rows_count, np.nan),
+            'percent': np.full(rows_count, np.nan),
+            'anomaly': np.full(rows_count, "Нет данных", dtype=object),
+        }
+
+    start = state['first']
+    end = state['last']
+    growth_count = state['growth']
+    decline_count = state['decline']
+
+    # Рассчитываем изменения
+    difference = end - start
+    has_difference = ~np.isnan(difference)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        percent = np.where(has_difference & (start != 0), difference / start * 100, np.nan)
+        mean = state['sum'] / state['count']
+
+    anomaly = np.where(has_difference & (np.abs(difference) > 2 * mean), "Аномалия", "ОК").astype(object)
+
+    if value_type in ['position', 'ctr']:
+        difference = np.round(difference)
+
+    dynamics = np.where(
+        end > start,
+        np.where(growth_count > decline_count, "Рост", "Стабильно"),
+        np.where(end < start, "Падение", "Стабильно"),
+    ).astype(object)
+    dynamics[~has_difference] = "Нет данных"
+
+    return {'dynamics': dynamics, 'difference': difference, 'percent': percent, 'anomaly': anomaly}
+
+
+def format_percent(percent):
+    """Format percent changes the way they are shown in the report ("12.5%" or None)."""
+    return [None if value != value else f"{round(value, 2)}%" for value in percent.tolist()]
+
+
+def build_metric_cube(df, metrics=METRICS):
+    """Parse `<date>_<metric>` columns once into a metrics x rows x days array with a shared date axis."""
+    dates = []
+    date_index = {}
+    metric_columns = {metric: [] for metric in metrics}
+    for col in df.columns:
+        date, separator, metric = str(col).rpartition('_')
+        if not separator or metric not in metric_columns:
+            continue
+        if date not in date_index:
+            date_index[date] = len(dates)
+            dates.append(date)
+        metric_columns[metric].append((date_index[date], col))
+
+    values = np.full((len(metrics), len(df), len(dates)), np.nan)
+    present = np.zeros((len(metrics), len(dates)), dtype=bool)
+    for metric_idx, metric in enumerate(metrics):
+        for date_idx, col in metric_columns[metric]:
+            values[metric_idx, :, date_idx] = df[col].to_numpy(dtype=float, na_value=np.nan)
+            present[metric_idx, date_idx] = True
+
+    return {'metrics': list(metrics), 'dates': dates, 'values': values, 'present': present}
+
+
+def metric_day_values(cube, value_type):
+    """Return the date indexes present for a metric and its rows x days value matrix."""
+    metric_idx = cube['metrics'].index(value_type)
+    day_indexes = np.flatnonzero(cube['present'][metric_idx])
+    return day_indexes, cube['values'][metric_idx][:, day_indexes]
+
+
+def metric_result_frame(queries, urls, cube, value_type, typed=False):
+    """Build the result table of one metric from the shared metric cube.
+
+    With typed=True "Процентное изменение" stays a float instead of the "12.5%" text shown in the report.
+    """
+    day_indexes, day_values = metric_day_values(cube, value_type)
+    # Готовые результаты (например, из накопленного состояния хранилища) не пересчитываются
+    result = cube.get('results', {}).get(value_type)
+    if result is None:
+        result = compute_dynamics(day_values, value_type)
+
+    # Строки остаются закодированными, декодирование происходит при записи
+    columns = {'Query': queries, 'Url': urls}
+    for position, date_idx in enumerate(day_indexes):
+        columns[f"{cube['dates'][date_idx]}_{value_type}"] = day_values[:, position]
+
+    # Добавляем рассчитанные данные в DataFrame
+    columns['Динамика изменений'] = result['dynamics']
+    columns['Значение изменения'] = result['difference']
+    columns['Процентное изменение'] = result['percent'] if typed else format_percent(result['percent'])
+    columns['Аномалия'] = result['anomaly']
+
+    return pd.DataFrame(columns)
+
+
 def calculate_dynamics_and_color(df, value_type):
     """Calculate dynamics, prepare the data, and identify anomalies."""
-    relevant_columns = [col for col in df.columns if col.endswith(f"_{value_type}")]
-    result_df = df[['Query', 'Url'] + relevant_columns].copy()
-
-    # Инициализация списков для значений
-    dynamics = []
-    differences = []
-    percent_changes = []
-    anomalies = []
-
-    for _, row in result_df.iterrows():
-        # Если данных недостаточно для анализа, заполняем None
-        if len(relevant_columns) < 2:
-            dynamics.append("Нет данных")
-            differences.append(None)
-            percent_changes.append(None)
-            anomalies.append("Нет данных")
+    cube = build_metric_cube(df, [value_type])
+    return metric_result_frame(df['Query'], df['Url'], cube, value_type)
+
+
+def day_change_fills(day_values):
+    """Return a rows x days array of fills comparing each day with the next one (the last day stays unfilled)."""
+    growth_fill, decline_fill, stable_fill = day_fills()
+    fills = np.full(day_values.shape, None, dtype=object)
+    current_values, next_values = day_values[:, :-1], day_values[:, 1:]
+    fills[:, :-1] = np.where(
+        next_values > current_values, growth_fill,
+        np.where(next_values < current_values, decline_fill, stable_fill),
+    )
+    return fills
+
+
+def add_day_change_rules(ws, days_count, rows_count):
+    """Color day cells by their change to the next day with range-level conditional formatting rules."""
+    if days_count < 2 or rows_count < 2:
+        return
+    from openpyxl.formatting.rule import FormulaRule
+    from openpyxl.utils import get_column_letter
+
+    first_cell, next_cell = "C2", "D2"
+    cell_range = f"C2:{get_column_letter(2 + days_count - 1)}{rows_count}"
+    both_numbers = f"ISNUMBER({first_cell}),ISNUMBER({next_cell})"
+    rules = [
+        (f"AND({both_numbers},{next_cell}>{first_cell})", GROWTH_COLOR),
+        (f"AND({both_numbers},{next_cell}<{first_cell})", DECLINE_COLOR),
+        ("TRUE", STABLE_COLOR),
+    ]
+
+    # Правила проверяются по порядку: рост, падение, иначе без изменений
+    for formula, color in rules:
+        ws.conditional_formatting.add(cell_range, FormulaRule(formula=[formula], fill=rule_fill(color), stopIfTrue=True))
+
+
+def rule_fill(color):
+    """Solid fill for a conditional formatting rule; Excel takes the color of a dxf fill from bgColor."""
+    from openpyxl.styles import PatternFill
+
+    return PatternFill(start_color=color, end_color=color, fill_type="solid")
+
+
+def register_styles(wb, ws):
+    """Register the report's cell and rule styles in a fixed order.
+
+    Workbooks written in separate processes then share identical style tables and their sheets can be merged.
+    """
+    from openpyxl.cell import WriteOnlyCell
+    from openpyxl.styles.differential import DifferentialStyle
+
+    # У openpyxl нет публичного способа зарегистрировать стиль заранее: стиль ячейки попадает в таблицу стилей
+    # книги при первом чтении style_id, а формат правила — в _differential_styles при записи листа.
+    # Поэтому style_id читается только ради регистрации, а форматы правил добавляются в список напрямую
+    for fill in day_fills():
+        cell = WriteOnlyCell(ws)
+        cell.fill = fill
+        cell.style_id
+    for color in (GROWTH_COLOR, DECLINE_COLOR, STABLE_COLOR):
+        wb._differential_styles.add(DifferentialStyle(fill=rule_fill(color)))
+
+
+def write_metric_rows(ws, sheet_data, days_count, coloring='fill'):
+    """Append the data rows of a metric sheet; with coloring='fill' every day cell gets its fill."""
+    if coloring == 'conditional':
+        for values in sheet_data.itertuples(index=False, name=None):
+            ws.append(values)
+        return
+    from openpyxl.cell import WriteOnlyCell
+
+    day_values = sheet_data.iloc[:, 2:2 + days_count].to_numpy(dtype=float, na_value=np.nan)
+    fills = day_change_fills(day_values)
+
+    # Строки добавляются по мере формирования, без промежуточного списка всех значений
+    for values, row_fills in zip(sheet_data.itertuples(index=False, name=None), fills):
+        row = list(values)
+        for offset, fill in enumerate(row_fills[:-1]):
+            cell = WriteOnlyCell(ws, value=row[2 + offset])
+            cell.fill = fill
+            row[2 + offset] = cell
+        ws.append(row)
+
+
+def write_metric(wb, query_values, url_values, cube, value_type, coloring='fill', max_rows=EXCEL_MAX_ROWS,
+                 formulas=False, chart_period=None):
+    """Compute one metric from the cube and write its (possibly split) sheet into the workbook."""
+    sheet_data = metric_result_frame(query_values, url_values, cube, value_type)
+    day_values = metric_day_values(cube, value_type)[1]
+    write_metric_result(wb, value_type, sheet_data, day_values, coloring, max_rows, formulas, chart_period)
+
+
+def write_metric_result(wb, value_type, sheet_data, day_values, coloring='fill', max_rows=EXCEL_MAX_ROWS,
+                        formulas=False, chart_period=None):
+    """Write an already computed metric result as a (possibly split) sheet of the workbook."""
+    sheet = open_metric_sheet(wb, value_type, sheet_data.columns.tolist(), day_values.shape[1], coloring, max_rows,
+                              chart_period)
+    append_metric_rows(sheet, sheet_data, day_values)
+    close_metric_sheet(sheet, formulas)
+
+
+def open_metric_sheet(wb, value_type, columns, days_count, coloring='fill', max_rows=EXCEL_MAX_ROWS,
+                      chart_period=None):
+    """Start a metric sheet that is split across numbered sheets when it outgrows max_rows.
+
+    chart_period ('day', 'week' or 'month') sets the chart buckets; by default it follows the number of days.
+    """
+    chart_period = choose_chart_period(days_count, chart_period)
+    state = {'wb': wb, 'value_type': value_type, 'columns': columns, 'days': days_count, 'coloring': coloring,
+             'chart_period': chart_period,
+             # Строка заголовка и строка "Итого" в каждом листе, плюс две строки сумм по периодам
+             'capacity': max_rows - (2 if chart_period == 'day' else 4), 'shards': [],
+             'totals': np.zeros(days_count)}
+    add_metric_shard(state)
+    return state
+
+
+def add_metric_shard(state):
+    """Open the next numbered sheet of a metric (Shows, then Shows_1, Shows_2, ...)."""
+    title = state['value_type'].capitalize()
+    shards = state['shards']
+    if len(shards) == 1:
+        shards[0]['ws'].title = f"{title}_1"
+    ws = state['wb'].create_sheet(title=f"{title}_{len(shards) + 1}" if shards else title)
+    ws.append(state['columns'])
+    shards.append({'ws': ws, 'rows': 0})
+
+
+def append_metric_rows(state, sheet_data, day_values):
+    """Append result rows to a metric sheet, moving on to a new numbered sheet when the current one is full."""
+    state['totals'] += np.nansum(day_values, axis=0)
+    start = 0
+    while start < len(sheet_data):
+        shard = state['shards'][-1]
+        free_rows = state['capacity'] - shard['rows']
+        if not free_rows:
+            add_metric_shard(state)
             continue
+        part = sheet_data.iloc[start:start + free_rows]
+        write_metric_rows(shard['ws'], part, state['days'], state['coloring'])
+        shard['rows'] += len(part)
+        start += len(part)
 
-        row_start = row[relevant_columns[0]]
-        row_end = row[relevant_columns[-1]]
-        growth_count = 0
-        decline_count = 0
-
-        for i in range(len(relevant_columns) - 1):
-            current_value = row[relevant_columns[i]]
-            next_value = row[relevant_columns[i + 1]]
-            if next_value > current_value:
-                growth_count += 1
-            elif next_value < current_value:
-                decline_count += 1
-
-        # Рассчитываем изменения
-        difference = row_end - row_start if pd.notna(row_start) and pd.notna(row_end) else None
-        percent_change = (
-            round((difference / row_start) * 100, 2)
-            if row_start and pd.notna(difference) and row_start != 0
-            else None
-        )
-        anomalies.append(
-            "Аномалия" if pd.notna(difference) and abs(difference) > 2 * row[relevant_columns].mean() else "ОК")
-
-        if value_type in ['position', 'ctr'] and pd.notna(difference):
-            difference = round(difference)
-
-        if pd.notna(difference):
-            if row_end > row_start and growth_count > decline_count:
-                dynamics.append("Рост")
-            elif row_end < row_start:
-                dynamics.append("Падение")
-            else:
-                dynamics.append("Стабильно")
+
+def close_metric_sheet(state, formulas=False):
+    """Finish a metric sheet: coloring rules on every shard, "Итого" and the chart on the last one.
+
+    Totals cover all shards: the per-day sums accumulated by append_metric_rows are written as values;
+    with formulas=True they are written as SUM formulas over every shard's range instead.
+    """
+    from openpyxl.utils import get_column_letter, quote_sheetname
+
+    shards = state['shards']
+    days_count = state['days']
+    if state['coloring'] == 'conditional':
+        for shard in shards:
+            add_day_change_rules(shard['ws'], days_count, shard['rows'] + 1)
+
+    day_columns = range(3, 3 + days_count)
+    totals = state['totals'].tolist()
+    if formulas:
+        totals = []
+        for col in day_columns:
+            col_letter = get_column_letter(col)
+            if len(shards) == 1:
+                totals.append(f"=SUM({col_letter}2:{col_letter}{shards[0]['rows'] + 1})")
+                continue
+            ranges = ",".join(
+                f"{quote_sheetname(shard['ws'].title)}!{col_letter}2:{col_letter}{shard['rows'] + 1}"
+                for shard in shards
+            )
+            totals.append(f"=SUM({ranges})")
+
+    buckets = None
+    if state['chart_period'] != 'day':
+        day_labels = [str(col).rpartition('_')[0] for col in state['columns'][2:2 + days_count]]
+        labels, starts = chart_buckets(day_labels, state['chart_period'])
+        sum_row = shards[-1]['rows'] + 2
+        if formulas:
+            ends = starts[1:] + [days_count]
+            bucket_totals = [f"=SUM({get_column_letter(3 + start)}{sum_row}:{get_column_letter(2 + end)}{sum_row})"
+                             for start, end in zip(starts, ends)]
         else:
-            dynamics.append("Нет данных")
+            bucket_totals = np.add.reduceat(state['totals'], starts).tolist()
+        buckets = (labels, bucket_totals)
 
-        differences.append(difference)
-        percent_changes.append(f"{percent_change}%" if percent_change is not None else None)
+    add_chart_to_sheet(shards[-1]['ws'], state['value_type'], shards[-1]['rows'] + 1, day_columns=day_columns,
+                       max_column=len(state['columns']), totals=totals, chart_period=state['chart_period'],
+                       buckets=buckets)
 
-    # Добавляем рассчитанные данные в DataFrame
-    result_df['Динамика изменений'] = dynamics
-    result_df['Значение изменения'] = differences
-    result_df['Процентное изменение'] = percent_changes
-    result_df['Аномалия'] = anomalies
 
-    return result_df
+def choose_chart_period(days_count, chart_period=None):
+    """Pick the chart buckets: days for up to two months, weeks for up to half a year, months beyond that."""
+    if chart_period not in (None, 'auto'):
+        return chart_period
+    if days_count <= CHART_DAILY_MAX_DAYS:
+        return 'day'
+    if days_count <= CHART_WEEKLY_MAX_DAYS:
+        return 'week'
+    return 'month'
 
 
-def add_chart_to_sheet(ws, value_type, rows_count):
-    """Add a bar chart to the sheet based on daily sums."""
-    # Определяем диапазон только для исходных данных (игнорируем расчетные столбцы)
-    relevant_cols = [
-        col for col in range(3, ws.max_column + 1)
-        if not ws.cell(row=1, column=col).value in ['Динамика изменений', 'Значение изменения', 'Процентное изменение', 'Аномалия']
-    ]
+def chart_buckets(day_labels, chart_period):
+    """Group consecutive day columns into calendar weeks or months; return bucket labels and start positions."""
+    labels, starts, keys = [], [], []
+    for position, label in enumerate(day_labels):
+        try:
+            day = to_date(label)
+            key = tuple(day.isocalendar())[:2] if chart_period == 'week' else (day.year, day.month)
+        except ValueError:
+            # Столбцы без даты объединяются подряд по 7 или 30
+            key = position // (7 if chart_period == 'week' else 30)
+        if not keys or key != keys[-1]:
+            keys.append(key)
+            starts.append(position)
+            labels.append([label, label])
+        else:
+            labels[-1][1] = label
+    return [first if first == last else f"{first} – {last}" for first, last in labels], starts
+
 
-    # Добавляем строку для сумм в конце данных
-    sum_row = rows_count
-    ws.cell(row=sum_row, column=1, value="Итого")
-    for col in relevant_cols:
-        col_letter = get_column_letter(col)
-        ws.cell(row=sum_row, column=col, value=f"=SUM({col_letter}2:{col_letter}{rows_count - 1})")
+def add_chart_to_sheet(ws, value_type, rows_count, day_columns, max_column, totals, chart_period='day', buckets=None):
+    """Add the "Итого" row and a bar chart of the daily sums to the sheet.
+
+    day_columns and max_column describe the sheet layout, so the worksheet itself is never scanned;
+    totals holds one value (or formula) per day column. For weekly or monthly charts buckets holds
+    the bucket labels and sums, written as two rows under "Итого" and used as the chart data.
+    """
+    from openpyxl.chart import BarChart, Reference
+    from openpyxl.utils import get_column_letter
+
+    # Диапазон дней известен из раскладки листа (расчетные столбцы идут после него)
+    relevant_cols = list(day_columns)
+
+    # Добавляем строку для сумм сразу после данных
+    sum_row = rows_count + 1
+    sum_values = [None] * max_column
+    sum_values[0] = "Итого"
+    for col, total in zip(relevant_cols, totals):
+        sum_values[col - 1] = total
+    ws.append(sum_values)
 
     # Создаем гистограмму на основе сумм
+    period_name, axis_title = CHART_PERIOD_NAMES[chart_period]
     chart = BarChart()
-    chart.title = f"Суммы значений по дням для {value_type.capitalize()}"
+    chart.title = f"Суммы значений по {period_name} для {value_type.capitalize()}"
     chart.style = 13
     chart.y_axis.title = "Сумма"
-    chart.x_axis.title = "Дни"
+    chart.x_axis.title = axis_title
 
     # Добавляем данные в график
-    data = Reference(ws, min_col=relevant_cols[0], max_col=relevant_cols[-1], min_row=sum_row, max_row=sum_row)
-    categories = Reference(ws, min_col=relevant_cols[0], max_col=relevant_cols[-1], min_row=1)
+    if buckets is None:
+        data = Reference(ws, min_col=relevant_cols[0], max_col=relevant_cols[-1], min_row=sum_row, max_row=sum_row)
+        categories = Reference(ws, min_col=relevant_cols[0], max_col=relevant_cols[-1], min_row=1)
+    else:
+        labels, bucket_totals = buckets
+        ws.append([f"Итого по {period_name}", None] + list(labels))
+        ws.append([None, None] + list(bucket_totals))
+        last_col = 2 + len(labels)
+        data = Reference(ws, min_col=3, max_col=last_col, min_row=sum_row + 2, max_row=sum_row + 2)
+        categories = Reference(ws, min_col=3, max_col=last_col, min_row=sum_row + 1, max_row=sum_row + 1)
     chart.add_data(data, titles_from_data=False)
     chart.set_categories(categories)
 
     # Располагаем график на листе
-    ws.add_chart(chart, f"{get_column_letter(ws.max_column + 2)}2")
+    ws.add_chart(chart, f"{get_column_letter(max_column + 2)}2")
 
 
-def process_file(input_path, output_path, urls, keywords, vitals, use_urls, use_keywords, use_vitals, analyze_only_brand):
-    """Process the selected Excel file."""
-    excel_data = pd.ExcelFile(input_path)
-    data = excel_data.parse(excel_data.sheet_names[0])
+class BackgroundWriter:
+    """Run workbook writing jobs in order on a separate thread fed through a bounded queue.
 
-    data = apply_filters(data, urls, keywords, vitals, use_urls, use_keywords, use_vitals, analyze_only_brand)
-    wb = Workbook()
+    The producer keeps computing the next metric or block while the previous one is being written;
+    submit() blocks once maxsize jobs are waiting, so finished results never pile up in memory.
+    An exception raised by a job is re-raised in the producer by the next submit() or by close().
+    With inline=True jobs run right away in the calling thread (used when profiling memory per stage).
+    """
 
-    for value_type in tqdm(['shows', 'position', 'demand', 'ctr', 'clicks'], desc="Processing metrics"):
-        relevant_columns = [col for col in data.columns if col.endswith(f"_{value_type}")]
-        if not relevant_columns:
-            continue
+    def __init__(self, maxsize=WRITER_QUEUE_SIZE, inline=False):
+        self._jobs = queue.Queue(maxsize)
+        self._error = None
+        self._thread = None
+        if not inline:
+            self._thread = threading.Thread(target=self._run, name="workbook-writer", daemon=True)
+            self._thread.start()
 
-        sheet_data = calculate_dynamics_and_color(data, value_type)
-        ws = wb.create_sheet(title=value_type.capitalize())
-
-        for r_idx, row in enumerate([sheet_data.columns.tolist()] + sheet_data.values.tolist(), 1):
-            for c_idx, value in enumerate(row, 1):
-                ws.cell(row=r_idx, column=c_idx, value=value)
-
-        # Apply coloring
-        for col_idx, col_name in enumerate(relevant_columns, 3):
-            for row_idx in range(2, len(sheet_data) + 2):
-                current_value = ws.cell(row=row_idx, column=col_idx).value
-                next_value = ws.cell(row=row_idx, column=col_idx + 1).value if col_idx + 1 < 3 + len(
-                    relevant_columns) else None
-
-                if next_value is not None:
-                    if next_value > current_value:
-                        ws.cell(row=row_idx, column=col_idx).fill = PatternFill(start_color="00FF00", fill_type="solid")
-                    elif next_value < current_value:
-                        ws.cell(row=row_idx, column=col_idx).fill = PatternFill(start_color="FF0000", fill_type="solid")
-                    else:
-                        ws.cell(row=row_idx, column=col_idx).fill = PatternFill(start_color="FFFF00", fill_type="solid")
+    def _run(self):
+        while True:
+            job = self._jobs.get()
+            if job is None:
+                return
+            # После ошибки оставшиеся задания только вычитываются, чтобы не блокировать производителя
+            if self._error is None:
+                func, args, kwargs = job
+                try:
+                    func(*args, **kwargs)
+                except BaseException as error:
+                    self._error = error
+
+    def submit(self, func, *args, **kwargs):
+        if self._error is not None:
+            raise self._error
+        if self._thread is None:
+            func(*args, **kwargs)
+            return
+        self._jobs.put((func, args, kwargs))
+
+    def close(self):
+        if self._thread is not None:
+            self._jobs.put(None)
+            self._thread.join()
+        if self._error is not None:
+            raise self._error
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, traceback):
+        if exc_type is None:
+            self.close()
+        elif self._thread is not None:
+            self._jobs.put(None)
+            self._thread.join()
 
-        add_chart_to_sheet(ws, value_type, len(sheet_data) + 1)
 
+def read_rss():
+    """Return the current and peak resident set size in bytes; None where the OS does not report it."""
+    try:
+        with open('/proc/self/status', encoding='ascii') as f:
+            fields = dict(line.split(':', 1) for line in f if ':' in line)
+        return int(fields['VmRSS'].split()[0]) * 1024, int(fields['VmHWM'].split()[0]) * 1024
+    except (OSError, KeyError, ValueError):
+        pass
+    try:
+        import resource
+    except ImportError:
+        return None, None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # macOS возвращает байты, остальные системы — килобайты
+    return None, peak if sys.platform == 'darwin' else peak * 1024
+
+
+def reset_peak_rss():
+    """Reset the peak RSS counter (Linux only); return whether later peaks cover just the time since."""
+    try:
+        with open('/proc/self/clear_refs', 'w', encoding='ascii') as f:
+            f.write('5')
+        return True
+    except OSError:
+        return False
+
+
+def reset_traced_peak():
+    """Reset the tracemalloc peak (Python 3.9+); return whether later peaks cover just the time since."""
+    if not hasattr(tracemalloc, 'reset_peak'):
+        return False
+    tracemalloc.reset_peak()
+    return True
+
+
+class RunStats:
+    """Wall time, CPU time and row counts of the stages of one run.
+
+    CPU time is measured for the thread that runs a stage, so stages overlapping with the background
+    writer are not counted twice; work done in worker processes is not included. With live=True every
+    finished stage is also printed to stderr.
+
+    With memory=True every stage also records its peak RSS and, through tracemalloc, its peak of traced
+    Python allocations and the top allocation sites of the memory it left allocated. This slows the run
+    down noticeably and is meant for sizing machines and checking memory optimizations.
+    """
+
+    def __init__(self, live=False, memory=False, top_allocations=10):
+        self.live = live
+        self.memory = memory
+        self.top_allocations = top_allocations
+        self.stages = []
+        self.started_at = datetime.now()
+        self._started = time.perf_counter()
+        self._cpu_started = time.process_time()
+        self._stop_tracing = memory and not tracemalloc.is_tracing()
+        self._peak_rss_per_stage = None
+        self._traced_peak_per_stage = None
+        if self._stop_tracing:
+            tracemalloc.start()
+
+    @contextmanager
+    def stage(self, name, rows_in=None, **details):
+        """Time the enclosed block; the yielded record accepts rows_out and other details."""
+        record = dict(stage=name, **details, rows_in=rows_in, rows_out=rows_in)
+        if self.memory:
+            self._peak_rss_per_stage = reset_peak_rss()
+            self._traced_peak_per_stage = reset_traced_peak()
+            snapshot = tracemalloc.take_snapshot()
+        started, cpu_started = time.perf_counter(), time.thread_time()
+        try:
+            yield record
+        finally:
+            seconds = time.perf_counter() - started
+            rows = record['rows_in'] if record['rows_in'] is not None else record['rows_out']
+            record.update(seconds=round(seconds, 6), cpu_seconds=round(time.thread_time() - cpu_started, 6),
+                          rows_per_second=round(rows / seconds, 1) if rows is not None and seconds else None)
+            if self.memory:
+                record['memory'] = self.measure_memory(snapshot)
+            self.stages.append(record)
+            if self.live:
+                from tqdm import tqdm
+
+                tqdm.write(self.describe(record), file=sys.stderr)
+
+    def call(self, name, rows_in, func, *args, **details):
+        """Run func(*args) as a stage; used for jobs handed to the background writer."""
+        with self.stage(name, rows_in, **details):
+            return func(*args)
+
+    def measure_memory(self, snapshot):
+        """Describe the memory of a stage that started at the given tracemalloc snapshot."""
+        rss, peak_rss = read_rss()
+        traced, traced_peak = tracemalloc.get_traced_memory()
+        ignore = [tracemalloc.Filter(False, tracemalloc.__file__)]
+        changes = tracemalloc.take_snapshot().filter_traces(ignore).compare_to(snapshot.filter_traces(ignore),
+                                                                              'lineno')
+        top = [
+            {'site': f"{change.traceback[0].filename}:{change.traceback[0].lineno}",
+             'size_bytes': change.size_diff, 'count': change.count_diff}
+            for change in sorted(changes, key=lambda change: change.size_diff, reverse=True)[:self.top_allocations]
+            if change.size_diff > 0
+        ]
+        return {'rss_bytes': rss, 'peak_rss_bytes': peak_rss, 'traced_bytes': traced,
+                'traced_peak_bytes': traced_peak, 'top_allocations': top}
+
+    @staticmethod
+    def describe(record):
+        """Format a stage record as one line of the live summary."""
+        label = f"{record['stage']} ({record['metric']})" if 'metric' in record else record['stage']
+        line = f"{label}: {record['seconds']:.3f} с, ЦП {record['cpu_seconds']:.3f} с"
+        if record['rows_in'] is not None:
+            line += f", строк {record['rows_in']} → {record['rows_out']}"
+        elif record['rows_out'] is not None:
+            line += f", строк {record['rows_out']}"
+        if record['rows_per_second']:
+            line += f", {record['rows_per_second']:.0f} строк/с"
+        if record.get('memory', {}).get('peak_rss_bytes'):
+            line += f", пик RSS {record['memory']['peak_rss_bytes'] / 2 ** 20:.0f} МБ"
+        return line
+
+    def totals(self):
+        """Sum the records of every stage name (a stage may run once per metric or per block)."""
+        totals = {}
+        for record in self.stages:
+            total = totals.setdefault(record['stage'], {'count': 0, 'seconds': 0.0, 'cpu_seconds': 0.0})
+            total['count'] += 1
+            total['seconds'] = round(total['seconds'] + record['seconds'], 6)
+            total['cpu_seconds'] = round(total['cpu_seconds'] + record['cpu_seconds'], 6)
+            if 'memory' in record:
+                for key in ('peak_rss_bytes', 'traced_peak_bytes'):
+                    value = record['memory'][key]
+                    if value is not None:
+                        total[key] = max(total.get(key, 0), value)
+        return totals
+
+    def close(self):
+        """Stop tracemalloc if this run started it."""
+        if self._stop_tracing:
+            tracemalloc.stop()
+            self._stop_tracing = False
+
+    def write_report(self, report_path, **run):
+        """Save the run report as JSON."""
+        report = dict(run, started=self.started_at.isoformat(timespec='seconds'),
+                      seconds=round(time.perf_counter() - self._started, 6),
+                      cpu_seconds=round(time.process_time() - self._cpu_started, 6),
+                      totals=self.totals(), stages=self.stages)
+        if self.memory:
+            peaks = [record['memory']['peak_rss_bytes'] for record in self.stages
+                     if record['memory']['peak_rss_bytes'] is not None]
+            # Без сброса пика (RSS не на Linux, tracemalloc до Python 3.9) пик этапа означает пик с начала
+            # замеров к концу этапа
+            report['memory'] = {'peak_rss_bytes': max(peaks, default=None),
+                                'peak_rss_per_stage': bool(self._peak_rss_per_stage),
+                                'traced_peak_per_stage': bool(self._traced_peak_per_stage)}
+        with open(report_path, 'w', encoding='utf-8') as f:
+            json.dump(report, f, ensure_ascii=False, indent=2, default=str)
+
+
+def report_output_path(output_path):
+    """Return the run report path next to the output: processed_x_report.json."""
+    return f"{os.path.splitext(output_path)[0]}_report.json"
+
+
+def save_workbook(wb, output_path):
+    """Drop the default empty sheet, if still present, and save the workbook."""
     if "Sheet" in wb.sheetnames:
         wb.remove(wb["Sheet"])
     wb.save(output_path)
 
 
-# Main logic
-if __name__ == "__main__":
+def table_output_path(output_path, table_format, value_type=None):
+    """Return the table file next to the report: processed_x_shows.parquet, or processed_x.parquet when combined."""
+    stem = os.path.splitext(output_path)[0]
+    suffix = f"_{value_type}" if value_type else ""
+    return f"{stem}{suffix}{TABLE_FORMATS[table_format]}"
+
+
+def write_table(frame, path, table_format):
+    """Write a result table as Parquet, Feather (both need pyarrow) or CSV."""
+    if table_format == 'parquet':
+        frame.to_parquet(path, index=False)
+    elif table_format == 'feather':
+        frame.to_feather(path)
+    else:
+        frame.to_csv(path, index=False)
+
+
+def write_result_tables(output_path, query_values, url_values, cube, value_types, table_format, combined=False):
+    """Write typed metric results for BI tools: one table per metric, or one combined table for all of them.
+
+    The combined table stacks the metrics under a "Metric" column, with day columns named by date only.
+    """
+    frames = []
+    for value_type in value_types:
+        frame = metric_result_frame(query_values, url_values, cube, value_type, typed=True)
+        if not combined:
+            write_table(frame, table_output_path(output_path, table_format, value_type), table_format)
+            continue
+        frame = frame.rename(columns=lambda col: col[:-len(value_type) - 1] if col.endswith(f"_{value_type}") else col)
+        frame.insert(2, 'Metric', value_type)
+        frames.append(frame)
+
+    if combined:
+        table = pd.concat(frames, ignore_index=True, sort=False)
+        # Столбцы дней разных показателей объединяются; расчетные столбцы переносятся в конец
+        result_columns = ['Динамика изменений', 'Значение изменения', 'Процентное изменение', 'Аномалия']
+        day_columns = sorted(col for col in table.columns if col not in ['Query', 'Url', 'Metric'] + result_columns)
+        table = table[['Query', 'Url', 'Metric'] + day_columns + result_columns]
+        write_table(table, table_output_path(output_path, table_format), table_format)
+
+
+def process_file(input_path, output_path, urls, keywords, vitals, use_urls, use_keywords, use_vitals, analyze_only_brand,
+                 write_only=False, coloring='fill', metrics=METRICS, date_from=None, date_to=None, cache_dir=CACHE_DIR,
+                 chunk_size=None, max_rows_per_sheet=EXCEL_MAX_ROWS, progress=True, metric_workers=None,
+                 total_formulas=False, chart_period=None, table_format=None, combined_table=False, write_excel=True,
+                 store_path=None, run_report=True, live_stats=False, memory_profile=False):
+    """Process the selected Excel file.
+
+    With write_only=True the workbook is streamed to disk row by row, keeping memory bounded on large exports.
+    coloring='conditional' colors day cells with conditional formatting rules instead of per-cell fills.
+    Only the Query/Url columns and the day columns of the selected metrics within date_from..date_to are read.
+    The parsed sheet is cached in cache_dir for later runs; cache_dir=None disables caching.
+    With chunk_size set, an .xlsx export is processed in blocks of that many rows (see process_file_in_chunks).
+    Metrics with more rows than fit into one sheet are split across numbered sheets (Shows_1, Shows_2, ...).
+    With metric_workers > 1 the metric sheets are computed and serialized in parallel worker processes.
+    The "Итого" row holds precomputed per-day sums; total_formulas=True writes SUM formulas instead.
+    Charts show days, weeks or months depending on the history length unless chart_period says otherwise.
+    table_format ('parquet', 'feather' or 'csv') also writes typed result tables next to output_path
+    (see write_result_tables); write_excel=False skips the Excel report.
+    With store_path set, the data for date_from..date_to comes from the history store instead of input_path
+    (see ingest_export). A list of input paths is merged into one table first (see merge_exports).
+    Stage timings and row counts go to a JSON run report next to output_path (run_report=False disables it);
+    live_stats=True also prints them to stderr as the stages finish. memory_profile=True adds the peak RSS and
+    the top tracemalloc allocation sites of every stage to the report; sheets are then written without the
+    background thread, so that allocations are attributed to the right stage.
+    """
+    stats = RunStats(live_stats, memory_profile)
+    status = 'ok'
+    try:
+        metrics = [metric for metric in METRICS if metric in metrics]
+        if chunk_size and store_path is None and str(input_path).lower().endswith('.xlsx'):
+            if table_format or not write_excel:
+                raise ValueError("Таблицы результатов не поддерживаются при обработке блоками (chunk_size)")
+            process_file_in_chunks(input_path, output_path, urls, keywords, vitals, use_urls, use_keywords,
+                                   use_vitals, analyze_only_brand, chunk_size, coloring, metrics, date_from, date_to,
+                                   max_rows_per_sheet, progress, total_formulas, chart_period, stats)
+            return
+
+        with stats.stage('load') as record:
+            if store_path is not None:
+                data = read_store(store_path, metrics, date_from, date_to)
+            elif isinstance(input_path, (list, tuple)):
+                data = merge_exports(input_path, metrics, date_from, date_to)
+            else:
+                data = read_cached_export(input_path, cache_dir, metrics, date_from, date_to)
+            record['rows_out'] = len(data)
+
+        with stats.stage('apply_filters', len(data)) as record:
+            data = apply_filters(data, urls, keywords, vitals, use_urls, use_keywords, use_vitals,
+                                 analyze_only_brand)
+            record['rows_out'] = len(data)
+
+        # Разбираем столбцы метрик один раз для всех листов
+        with stats.stage('build_metric_cube', len(data)):
+            cube = build_metric_cube(data, metrics)
+            if store_path is not None and date_from is None and date_to is None:
+                # Вся история: динамика берется из накопленного состояния, без пересчета по всем дням
+                cube['results'] = {metric: read_store_dynamics(store_path, metric, data.index.to_numpy())
+                                   for metric in metrics}
+        query_values, url_values = data['Query'].array, data['Url'].array
+        rows_count = len(data)
+        del data
+
+        value_types = [value_type for metric_idx, value_type in enumerate(cube['metrics'])
+                       if cube['present'][metric_idx].any()]
+        if not value_types:
+            raise ValueError("Нет данных по выбранным показателям за выбранный период")
+        if table_format:
+            with stats.stage('write_tables', rows_count):
+                write_result_tables(output_path, query_values, url_values, cube, value_types, table_format,
+                                    combined_table)
+        if not write_excel:
+            return
+
+        if metric_workers and metric_workers > 1 and len(value_types) > 1:
+            with stats.stage('write_metrics_in_parallel', rows_count):
+                write_metrics_in_parallel(output_path, query_values, url_values, cube, value_types, coloring,
+                                          max_rows_per_sheet, metric_workers, progress, total_formulas,
+                                          chart_period)
+            return
+
+        from openpyxl import Workbook
+        from tqdm import tqdm
+
+        wb = Workbook(write_only=write_only)
+
+        # Следующий показатель считается, пока предыдущий записывается в книгу в фоновом потоке
+        with BackgroundWriter(inline=stats.memory) as writer:
+            for value_type in tqdm(value_types, desc="Processing metrics", disable=not progress):
+                with stats.stage('calculate_dynamics', rows_count, metric=value_type):
+                    sheet_data = metric_result_frame(query_values, url_values, cube, value_type)
+                    day_values = metric_day_values(cube, value_type)[1]
+                writer.submit(stats.call, 'write_sheet', rows_count, write_metric_result, wb, value_type, sheet_data,
+                              day_values, coloring, max_rows_per_sheet, total_formulas, chart_period,
+                              metric=value_type)
+            writer.submit(stats.call, 'save', rows_count, save_workbook, wb, output_path)
+    except BaseException as error:
+        # KeyboardInterrupt и SystemExit тоже не должны попадать в отчет как успешный запуск
+        status = f"error: {type(error).__name__}: {error}"
+        raise
+    finally:
+        stats.close()
+        if run_report:
+            # Ошибка записи отчета не должна скрывать ошибку обработки
+            try:
+                stats.write_report(report_output_path(output_path), input=input_path, store=store_path,
+                                   output=output_path if write_excel else None, status=status)
+            except OSError:
+                if status == 'ok':
+                    raise
+
+
+def process_file_in_chunks(input_path, output_path, urls, keywords, vitals, use_urls, use_keywords, use_vitals,
+                           analyze_only_brand, chunk_size, coloring='fill', metrics=METRICS, date_from=None,
+                           date_to=None, max_rows_per_sheet=EXCEL_MAX_ROWS, progress=True,
+                           total_formulas=False, chart_period=None, stats=None):
+    """Process an export block by block, so peak memory depends on chunk_size rather than on the file size.
+
+    Each block is filtered, analysed and appended to a write-only workbook before the next one is read;
+    only the per-day "Итого" sums are accumulated across blocks. Stage timings are added to stats if given.
+    """
+    from openpyxl import Workbook
+    from tqdm import tqdm
+
+    stats = stats or RunStats()
+    usecols = select_columns(read_header(input_path), metrics, date_from, date_to)
+    layout = build_metric_cube(pd.DataFrame(columns=usecols), metrics)
+
+    wb = Workbook(write_only=True)
+    sheets = {}
+    for metric_idx, value_type in enumerate(layout['metrics']):
+        days_count = int(layout['present'][metric_idx].sum())
+        if not days_count:
+            continue
+        columns = metric_result_frame([], [], layout, value_type).columns.tolist()
+        sheets[value_type] = open_metric_sheet(wb, value_type, columns, days_count, coloring, max_rows_per_sheet,
+                                               chart_period)
+    if not sheets:
+        raise ValueError("Нет данных по выбранным показателям за выбранный период")
+
+    # Следующий блок читается и считается, пока предыдущий дописывается в книгу в фоновом потоке
+    with BackgroundWriter(inline=stats.memory) as writer:
+        chunks = iter_export_chunks(input_path, chunk_size, metrics, date_from, date_to)
+        for chunk in tqdm(timed_chunks(stats, chunks), desc="Processing chunks", unit="chunk", disable=not progress):
+            with stats.stage('apply_filters', len(chunk)) as record:
+                chunk = apply_filters(chunk, urls, keywords, vitals, use_urls, use_keywords, use_vitals,
+                                      analyze_only_brand)
+                record['rows_out'] = len(chunk)
+            with stats.stage('build_metric_cube', len(chunk)):
+                cube = build_metric_cube(chunk, metrics)
+            for value_type, sheet in sheets.items():
+                with stats.stage('calculate_dynamics', len(chunk), metric=value_type):
+                    sheet_data = metric_result_frame(chunk['Query'].array, chunk['Url'].array, cube, value_type)
+                writer.submit(stats.call, 'write_sheet', len(chunk), append_metric_rows, sheet, sheet_data,
+                              metric_day_values(cube, value_type)[1], metric=value_type)
+        writer.submit(stats.call, 'save', None, finish_chunked_workbook, wb, sheets, output_path, total_formulas)
+
+
+def timed_chunks(stats, chunks):
+    """Yield the blocks of a chunk iterator, timing the reading of each one as a 'load' stage."""
+    while True:
+        with stats.stage('load') as record:
+            chunk = next(chunks, None)
+            record['rows_out'] = 0 if chunk is None else len(chunk)
+        if chunk is None:
+            return
+        yield chunk
+
+
+def finish_chunked_workbook(wb, sheets, output_path, formulas=False):
+    """Close every metric sheet of a chunked run and save the workbook with the sheets ordered by metric."""
+    for sheet in sheets.values():
+        close_metric_sheet(sheet, formulas)
+
+    # Листы частей создаются по мере заполнения; упорядочиваем их по метрикам
+    wb._sheets = [shard['ws'] for sheet in sheets.values() for shard in sheet['shards']]
+
+    wb.save(output_path)
+
+
+def init_metric_worker(shared):
+    """Keep the filtered Query/Url arrays and the metric cube in a metric worker process."""
+    global _METRIC_WORKER_DATA
+    _METRIC_WORKER_DATA = shared
+
+
+def write_metric_part(value_type, part_path, coloring='fill', max_rows=EXCEL_MAX_ROWS, formulas=False,
+                      chart_period=None):
+    """Write one metric into its own write-only workbook; runs in a metric worker process.
+
+    Returns the part path and the names of the sheets written into it.
+    """
+    from openpyxl import Workbook
+
+    query_values, url_values, cube = _METRIC_WORKER_DATA
+    wb = Workbook(write_only=True)
+    register_styles(wb, wb.create_sheet())
+    wb.remove(wb.worksheets[0])
+    write_metric(wb, query_values, url_values, cube, value_type, coloring, max_rows, formulas, chart_period)
+    wb.save(part_path)
+    return part_path, wb.sheetnames
+
+
+def write_metrics_in_parallel(output_path, query_values, url_values, cube, value_types, coloring='fill',
+                              max_rows=EXCEL_MAX_ROWS, workers=None, progress=True, formulas=False,
+                              chart_period=None):
+    """Compute and serialize metric sheets in worker processes, then assemble them into one workbook."""
+    from tqdm import tqdm
+
+    # При fork данные достаются процессам без сериализации
+    context = multiprocessing.get_context('fork') if 'fork' in multiprocessing.get_all_start_methods() else None
+    output_dir = os.path.dirname(os.path.abspath(output_path))
+    with tempfile.TemporaryDirectory(dir=output_dir, prefix='.wm_parts_') as temp_dir:
+        with ProcessPoolExecutor(max_workers=min(workers or os.cpu_count() or 1, len(value_types)),
+                                 mp_context=context, initializer=init_metric_worker,
+                                 initargs=((query_values, url_values, cube),)) as executor:
+            futures = [
+                executor.submit(write_metric_part, value_type, os.path.join(temp_dir, f"{value_type}.xlsx"),
+                                coloring, max_rows, formulas, chart_period)
+                for value_type in value_types
+            ]
+            parts = [future.result() for future in tqdm(futures, desc="Processing metrics", disable=not progress)]
+        part_paths, sheet_names = zip(*parts)
+        merge_workbook_parts(part_paths, output_path, sheet_names)
+
+
+def package_part_name(base_dir, target):
+    """Resolve a relationship target to a part name inside the package."""
+    if target.startswith('/'):
+        return target[1:]
+    return posixpath.normpath(posixpath.join(base_dir, target))
+
+
+def part_xml(root, namespace):
+    """Serialize an XML part with its own namespace as the default one, the way openpyxl writes its parts."""
+    # Элементы пространства имен части пишутся без префикса, а само пространство объявляется атрибутом xmlns
+    qualifier = f"{{{namespace}}}"
+    for element in root.iter():
+        if element.tag.startswith(qualifier):
+            element.tag = element.tag[len(qualifier):]
+    root.set('xmlns', namespace)
+    return ElementTree.tostring(root, encoding='UTF-8', xml_declaration=True)
+
+
+def merge_workbook_parts(part_paths, output_path, sheet_names=None):
+    """Assemble workbooks written by metric workers into a single workbook, keeping the sheet order.
+
+    Every part must have been written with register_styles, so all parts share the same styles.xml.
+    sheet_names, if given, lists the sheets each part is expected to hold; a part holding anything else is an error.
+    """
+    ElementTree.register_namespace('r', OFFICE_REL_NS)
+    sheet_entries = []
+    overrides = {}
+    counters = {}
+
+    with zipfile.ZipFile(output_path, 'w', zipfile.ZIP_DEFLATED) as out:
+        def copy_part(part, name):
+            """Copy a part together with its related parts under new names; returns the new part name."""
+            folder, file_name = posixpath.split(name)
+            stem = re.sub(r'\d*\.xml$', '', file_name)
+            counters[folder] = counters.get(folder, 0) + 1
+            new_name = f"{folder}/{stem}{counters[folder]}.xml"
+
+            rels_name = f"{folder}/_rels/{file_name}.rels"
+            if rels_name in part.namelist():
+                rels = ElementTree.fromstring(part.read(rels_name))
+                for rel in rels.iter(f"{{{PACKAGE_REL_NS}}}Relationship"):
+                    if rel.get('TargetMode') != 'External':
+                        rel.set('Target', f"/{copy_part(part, package_part_name(folder, rel.get('Target')))}")
+                out.writestr(f"{folder}/_rels/{posixpath.basename(new_name)}.rels", part_xml(rels, PACKAGE_REL_NS))
+            out.writestr(new_name, part.read(name))
+            overrides[f"/{new_name}"] = part_content_types[f"/{name}"]
+            return new_name
+
+        for index, part_path in enumerate(part_paths):
+            with zipfile.ZipFile(part_path) as part:
+                content_types = ElementTree.fromstring(part.read('[Content_Types].xml'))
+                part_content_types = {override.get('PartName'): override.get('ContentType')
+                                      for override in content_types.iter(f"{{{CONTENT_TYPES_NS}}}Override")}
+                if index == 0:
+                    base_styles = part.read('xl/styles.xml')
+                    base_workbook = ElementTree.fromstring(part.read('xl/workbook.xml'))
+                    base_rels = ElementTree.fromstring(part.read('xl/_rels/workbook.xml.rels'))
+                    defaults = list(content_types.iter(f"{{{CONTENT_TYPES_NS}}}Default"))
+                    overrides['/xl/workbook.xml'] = part_content_types['/xl/workbook.xml']
+                    # Общие части книги (стили, тема, свойства документа) берем из первой части
+                    for name in part.namelist():
+                        if not name.startswith(('xl/worksheets/', 'xl/drawings/', 'xl/charts/')) and name not in (
+                                '[Content_Types].xml', 'xl/workbook.xml', 'xl/_rels/workbook.xml.rels'):
+                            out.writestr(name, part.read(name))
+                            if f"/{name}" in part_content_types:
+                                overrides[f"/{name}"] = part_content_types[f"/{name}"]
+                elif part.read('xl/styles.xml') != base_styles:
+                    raise ValueError(f"Таблицы стилей частей книги не совпадают: {part_path}")
+
+                workbook = ElementTree.fromstring(part.read('xl/workbook.xml'))
+                workbook_rels = {rel.get('Id'): rel for rel in ElementTree.fromstring(
+                    part.read('xl/_rels/workbook.xml.rels')).iter(f"{{{PACKAGE_REL_NS}}}Relationship")}
+                names = []
+                for sheet in workbook.iter(f"{{{SPREADSHEET_NS}}}sheet"):
+                    rel = workbook_rels[sheet.get(f"{{{OFFICE_REL_NS}}}id")]
+                    if rel.get('Type') != WORKSHEET_REL_TYPE:
+                        raise ValueError(f"Лист {sheet.get('name')} части книги {part_path} не является таблицей")
+                    new_name = copy_part(part, package_part_name('xl', rel.get('Target')))
+                    sheet_entries.append((sheet, new_name))
+                    names.append(sheet.get('name'))
+                expected = sheet_names[index] if sheet_names is not None else names
+                if not names or names != list(expected):
+                    raise ValueError(f"Часть книги {part_path} содержит листы {names}, ожидались {list(expected)}")
+
+        sheets = base_workbook.find(f"{{{SPREADSHEET_NS}}}sheets")
+        for sheet in list(sheets):
+            sheets.remove(sheet)
+        for number, (sheet, _) in enumerate(sheet_entries, 1):
+            sheet.set('sheetId', str(number))
+            sheet.set(f"{{{OFFICE_REL_NS}}}id", f"rId{number}")
+            sheets.append(sheet)
+        out.writestr('xl/workbook.xml', part_xml(base_workbook, SPREADSHEET_NS))
+
+        relationships = ElementTree.Element(f"{{{PACKAGE_REL_NS}}}Relationships")
+        for number, (_, new_name) in enumerate(sheet_entries, 1):
+            ElementTree.SubElement(relationships, f"{{{PACKAGE_REL_NS}}}Relationship",
+                                   Type=WORKSHEET_REL_TYPE, Target=f"/{new_name}", Id=f"rId{number}")
+        other_rels = [rel for rel in base_rels.iter(f"{{{PACKAGE_REL_NS}}}Relationship")
+                      if rel.get('Type') != WORKSHEET_REL_TYPE]
+        for number, rel in enumerate(other_rels, len(sheet_entries) + 1):
+            rel.set('Id', f"rId{number}")
+            relationships.append(rel)
+        out.writestr('xl/_rels/workbook.xml.rels', part_xml(relationships, PACKAGE_REL_NS))
+
+        types = ElementTree.Element(f"{{{CONTENT_TYPES_NS}}}Types")
+        types.extend(defaults)
+        for name, content_type in overrides.items():
+            ElementTree.SubElement(types, f"{{{CONTENT_TYPES_NS}}}Override", PartName=name, ContentType=content_type)
+        out.writestr('[Content_Types].xml', part_xml(types, CONTENT_TYPES_NS))
+
+
+def parse_date_argument(value):
+    """Parse a YYYY-MM-DD command-line date."""
+    try:
+        return to_date(value)
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"некорректная дата '{value}', ожидается ГГГГ-ММ-ДД")
+
+
+def build_arg_parser():
+    """Build the command-line interface."""
+    parser = argparse.ArgumentParser(
+        description="Анализ динамики запросов из выгрузки «Мониторинг запросов» Яндекс.Вебмастера. "
+                    "Без аргументов скрипт работает в интерактивном режиме.")
+    parser.add_argument('inputs', nargs='*',
+                        help="Excel-файлы выгрузки (.xlsx/.xls), папки или шаблоны вида 'exports/*.xlsx'")
+    parser.add_argument('-o', '--output',
+                        help="итоговый файл; для нескольких входных файлов — папка для результатов "
+                             "(по умолчанию processed_<имя файла> рядом с исходным)")
+    parser.add_argument('-j', '--jobs', type=int,
+                        help="число параллельных процессов для нескольких файлов (по умолчанию число ядер)")
+    parser.add_argument('--summary',
+                        help="JSON-сводка пакетного запуска (по умолчанию run_summary.json в папке результатов)")
+    parser.add_argument('--urls-file', default='urls.txt', help="файл фильтра по URL (по умолчанию urls.txt)")
+    parser.add_argument('--keywords-file', default='keyword.txt',
+                        help="файл фильтра по ключам (по умолчанию keyword.txt)")
+    parser.add_argument('--vitals-file', default='vital.txt',
+                        help="файл брендовых запросов (по умолчанию vital.txt)")
+    parser.add_argument('--filter-urls', action='store_true', help="оставить только URL из файла фильтра")
+    parser.add_argument('--filter-keywords', action='store_true', help="оставить только ключи из файла фильтра")
+    parser.add_argument('--exclude-brand', action='store_true', help="удалить запросы с брендом")
+    parser.add_argument('--only-brand', action='store_true', help="анализировать только запросы с брендом")
+    parser.add_argument('--metrics', nargs='+', choices=METRICS, default=METRICS, metavar='METRIC',
+                        help=f"показатели для анализа: {', '.join(METRICS)} (по умолчанию все)")
+    parser.add_argument('--date-from', type=parse_date_argument, help="первый день периода (ГГГГ-ММ-ДД)")
+    parser.add_argument('--date-to', type=parse_date_argument, help="последний день периода (ГГГГ-ММ-ДД)")
+    parser.add_argument('--write-only', action='store_true', help="потоковая запись Excel с ограниченной памятью")
+    parser.add_argument('--coloring', choices=['fill', 'conditional'], default='fill',
+                        help="заливка ячеек или условное форматирование (по умолчанию fill)")
+    parser.add_argument('--chunk-size', type=int, help="обрабатывать выгрузку блоками по указанному числу строк")
+    parser.add_argument('--metric-workers', type=int,
+                        help="считать и записывать листы показателей в указанном числе параллельных процессов")
+    parser.add_argument('--total-formulas', action='store_true',
+                        help="записывать строку «Итого» формулами SUM вместо готовых сумм")
+    parser.add_argument('--chart-period', choices=['auto'] + CHART_PERIODS, default='auto',
+                        help="столбцы диаграммы: по дням, неделям или месяцам "
+                             "(по умолчанию выбираются по длине периода)")
+    parser.add_argument('--table-format', choices=list(TABLE_FORMATS),
+                        help="дополнительно сохранить результаты в таблицы Parquet, Feather или CSV")
+    parser.add_argument('--combined-table', action='store_true',
+                        help="одна общая таблица для всех показателей вместо таблицы на показатель")
+    parser.add_argument('--no-excel', action='store_true', help="не создавать Excel-отчет (только таблицы)")
+    parser.add_argument('--merge', action='store_true',
+                        help="объединить все входные файлы (и все их листы) в один отчет на общей оси дат")
+    parser.add_argument('--store',
+                        help="файл хранилища истории (SQLite): входные файлы загружаются в него, "
+                             "а отчет строится по хранилищу за период --date-from..--date-to")
+    parser.add_argument('--ingest-only', action='store_true',
+                        help="только загрузить выгрузки в хранилище, без отчета")
+    parser.add_argument('--no-report', action='store_true',
+                        help="не сохранять отчет о времени этапов (<имя результата>_report.json)")
+    parser.add_argument('--live-stats', action='store_true',
+                        help="выводить время и число строк каждого этапа в stderr по ходу работы")
+    parser.add_argument('--memory-profile', action='store_true',
+                        help="записать в отчет пиковую память и главные места выделения памяти для каждого этапа "
+                             "(заметно замедляет работу)")
+    parser.add_argument('--cache-dir', default=CACHE_DIR,
+                        help=f"папка кэша разобранных выгрузок (по умолчанию {CACHE_DIR} рядом с файлом)")
+    parser.add_argument('--no-cache', action='store_true', help="не использовать кэш")
+    return parser
+
+
+def default_output_path(input_path, output=None, several_inputs=False):
+    """Return the output path for an input: processed_<name> next to it or inside the output folder."""
+    file_name = f"processed_{os.path.basename(input_path)}"
+    if output is None:
+        return os.path.join(os.path.dirname(os.path.abspath(input_path)), file_name)
+    if several_inputs or os.path.isdir(output):
+        return os.path.join(output, file_name)
+    return output
+
+
+def run_interactive():
+    """Choose the file and the filters through console prompts."""
     current_directory = os.getcwd()
     print(f"Текущая папка: {current_directory}")
 
     excel_files = [f for f in os.listdir(current_directory) if f.endswith(('.xlsx', '.xls'))]
     if not excel_files:
         print("Excel-файлы не найдены.")
+        return 1
+
+    print("Найдены файлы:")
+    for idx, file_name in enumerate(excel_files, start=1):
+        print(f"{idx}: {file_name}")
+
+    file_number = int(input("Укажите номер файла для обработки: ")) - 1
+    if not 0 <= file_number < len(excel_files):
+        print("Некорректный номер файла.")
+        return 1
+
+    input_file = os.path.join(current_directory, excel_files[file_number])
+    output_file = os.path.join(current_directory, f"processed_{excel_files[file_number]}")
+
+    urls = load_filter_file('urls.txt')
+    keywords = load_filter_file('keyword.txt')
+    vitals = load_filter_file('vital.txt')
+
+    use_urls = get_yes_no_input("Использовать ли фильтр по URL? Да/Нет: ")
+    use_keywords = get_yes_no_input("Использовать ли фильтр по ключам? Да/Нет: ")
+    use_vitals = get_yes_no_input("Удалить ли запросы с брендом? Да/Нет: ")
+    analyze_only_brand = get_yes_no_input("Анализировать только запросы с брендом? Да/Нет: ")
+
+    process_file(input_file, output_file, urls, keywords, vitals, use_urls, use_keywords, use_vitals,
+                 analyze_only_brand)
+    print(f"Файл сохранен: {output_file}")
+    return 0
+
+
+def expand_inputs(inputs):
+    """Expand folders and glob patterns into the list of exports to process."""
+    files = []
+    for item in inputs:
+        if os.path.isdir(item):
+            candidates = sorted(os.path.join(item, name) for name in os.listdir(item))
+        elif any(char in item for char in '*?['):
+            candidates = sorted(glob.glob(item))
+        else:
+            files.append(item)
+            continue
+        for path in candidates:
+            name = os.path.basename(path)
+            # Пропускаем результаты прошлых запусков и временные файлы Excel
+            if name.lower().endswith(('.xlsx', '.xls')) and not name.startswith(('processed_', '~$')):
+                files.append(path)
+    return list(dict.fromkeys(files))
+
+
+def process_export(task):
+    """Run process_file for one export and return its record for the run summary."""
+    started = time.perf_counter()
+    record = {'input': task['input_path'], 'output': task['output_path']}
+    try:
+        process_file(**task)
+    except Exception as error:
+        record.update(status='error', error=f"{type(error).__name__}: {error}")
     else:
-        print("Найдены файлы:")
-        for idx, file_name in enumerate(excel_files, start=1):
-            print(f"{idx}: {file_name}")
-
-        file_number = int(input("Укажите номер файла для обработки: ")) - 1
-        if 0 <= file_number < len(excel_files):
-            input_file = os.path.join(current_directory, excel_files[file_number])
-            output_file = os.path.join(current_directory, f"processed_{excel_files[file_number]}")
-
-            urls = load_filter_file('urls.txt')
-            keywords = load_filter_file('keyword.txt')
-            vitals = load_filter_file('vital.txt')
-
-            use_urls = get_yes_no_input("Использовать ли фильтр по URL? Да/Нет: ")
-            use_keywords = get_yes_no_input("Использовать ли фильтр по ключам? Да/Нет: ")
-            use_vitals = get_yes_no_input("Удалить ли запросы с брендом? Да/Нет: ")
-            analyze_only_brand = get_yes_no_input("Анализировать только запросы с брендом? Да/Нет: ")
-
-            process_file(input_file, output_file, urls, keywords, vitals, use_urls, use_keywords, use_vitals,
-                         analyze_only_brand)
-            print(f"Файл сохранен: {output_file}")
+        record.update(status='ok')
+        if task.get('write_excel', True):
+            record['output_bytes'] = os.path.getsize(task['output_path'])
+    record['seconds'] = round(time.perf_counter() - started, 3)
+    return record
+
+
+def run_batch(tasks, jobs=None):
+    """Process many exports on a pool of worker processes; records are returned in input order."""
+    jobs = min(jobs or os.cpu_count() or 1, len(tasks))
+    if jobs <= 1:
+        return [process_export(task) for task in tasks]
+    from tqdm import tqdm
+
+    records = [None] * len(tasks)
+    with ProcessPoolExecutor(max_workers=jobs) as executor:
+        futures = {executor.submit(process_export, dict(task, progress=False)): index
+                   for index, task in enumerate(tasks)}
+        for future in tqdm(as_completed(futures), total=len(futures), desc="Processing files", unit="file"):
+            records[futures[future]] = future.result()
+    return records
+
+
+def write_run_summary(summary_path, records, seconds, jobs):
+    """Save the aggregate summary of a batch run as JSON."""
+    summary = {
+        'finished': datetime.now().isoformat(timespec='seconds'),
+        'seconds': round(seconds, 3),
+        'jobs': jobs,
+        'files': len(records),
+        'succeeded': sum(record['status'] == 'ok' for record in records),
+        'failed': sum(record['status'] != 'ok' for record in records),
+        'results': records,
+    }
+    with open(summary_path, 'w', encoding='utf-8') as f:
+        json.dump(summary, f, ensure_ascii=False, indent=2)
+
+
+def run_store(store_path, input_files, output, options, ingest_only=False):
+    """Load exports into the history store, then build one report from it; return the exit code."""
+    for input_file in input_files:
+        try:
+            written = ingest_export(store_path, input_file, options['metrics'], options['cache_dir'])
+        except Exception as error:
+            print(f"Ошибка при загрузке {input_file}: {type(error).__name__}: {error}", file=sys.stderr)
+            return 1
+        print(f"Загружено в хранилище: {input_file} ({written} значений)")
+    if ingest_only:
+        return 0
+
+    stem = os.path.splitext(os.path.basename(store_path))[0]
+    output_path = output or os.path.join(os.path.dirname(os.path.abspath(store_path)), f"processed_{stem}.xlsx")
+    record = process_export(dict(options, input_path=store_path, output_path=output_path, store_path=store_path))
+    if record['status'] != 'ok':
+        print(f"Ошибка при обработке {store_path}: {record['error']}", file=sys.stderr)
+        return 1
+    print(f"Файл сохранен: {output_path}" if 'output_bytes' in record else f"Таблицы сохранены для: {store_path}")
+    return 0
+
+
+def main(argv=None):
+    """Run the command-line interface and return the process exit code."""
+    argv = sys.argv[1:] if argv is None else argv
+    if not argv:
+        return run_interactive()
+
+    parser = build_arg_parser()
+    args = parser.parse_args(argv)
+    if not args.inputs and not args.store:
+        parser.error("не указаны входные файлы")
+    input_files = expand_inputs(args.inputs)
+    if args.inputs and not input_files:
+        parser.error("по указанным путям не найдено ни одного Excel-файла")
+    missing = [path for path in input_files if not os.path.isfile(path)]
+    if missing:
+        parser.error(f"файлы не найдены: {', '.join(missing)}")
+    if args.chunk_size is not None and args.chunk_size <= 0:
+        parser.error("--chunk-size должен быть положительным")
+    if args.jobs is not None and args.jobs <= 0:
+        parser.error("--jobs должен быть положительным")
+    if args.metric_workers is not None and args.metric_workers <= 0:
+        parser.error("--metric-workers должен быть положительным")
+    if args.date_from and args.date_to and args.date_from > args.date_to:
+        parser.error("--date-from позже --date-to")
+    if args.no_excel and not args.table_format:
+        parser.error("--no-excel требует --table-format")
+    if args.table_format and args.chunk_size:
+        parser.error("--table-format нельзя совмещать с --chunk-size")
+    if args.table_format in ('parquet', 'feather') and importlib.util.find_spec('pyarrow') is None:
+        parser.error(f"для --table-format {args.table_format} нужен пакет pyarrow")
+    if args.ingest_only and not args.store:
+        parser.error("--ingest-only требует --store")
+    if args.store and args.chunk_size:
+        parser.error("--store нельзя совмещать с --chunk-size")
+    if args.memory_profile and args.no_report:
+        parser.error("--memory-profile записывает результаты в отчет и несовместим с --no-report")
+    if args.merge and (args.store or args.chunk_size):
+        parser.error("--merge нельзя совмещать с --store и --chunk-size")
+    if args.store and not input_files and not os.path.isfile(args.store):
+        parser.error(f"хранилище не найдено: {args.store}")
+    several_inputs = len(input_files) > 1 and not args.store and not args.merge
+    if args.output and several_inputs:
+        os.makedirs(args.output, exist_ok=True)
+
+    urls = load_filter_file(args.urls_file)
+    keywords = load_filter_file(args.keywords_file)
+    vitals = load_filter_file(args.vitals_file)
+
+    options = dict(urls=urls, keywords=keywords, vitals=vitals, use_urls=args.filter_urls,
+                   use_keywords=args.filter_keywords, use_vitals=args.exclude_brand,
+                   analyze_only_brand=args.only_brand, write_only=args.write_only, coloring=args.coloring,
+                   metrics=args.metrics, date_from=args.date_from, date_to=args.date_to,
+                   cache_dir=None if args.no_cache else args.cache_dir, chunk_size=args.chunk_size,
+                   metric_workers=args.metric_workers, total_formulas=args.total_formulas,
+                   chart_period=args.chart_period, table_format=args.table_format,
+                   combined_table=args.combined_table, write_excel=not args.no_excel,
+                   run_report=not args.no_report, live_stats=args.live_stats, memory_profile=args.memory_profile)
+    if args.store:
+        return run_store(args.store, input_files, args.output, options, args.ingest_only)
+
+    if args.merge:
+        output_path = args.output or os.path.join(os.path.dirname(os.path.abspath(input_files[0])),
+                                                  "processed_merged.xlsx")
+        tasks = [dict(options, input_path=input_files, output_path=output_path)]
+    else:
+        tasks = [
+            dict(options, input_path=input_file,
+                 output_path=default_output_path(input_file, args.output, several_inputs))
+            for input_file in input_files
+        ]
+
+    started = time.perf_counter()
+    records = run_batch(tasks, args.jobs)
+    for record in records:
+        if record['status'] == 'ok' and 'output_bytes' in record:
+            print(f"Файл сохранен: {record['output']}")
+        elif record['status'] == 'ok':
+            print(f"Таблицы сохранены для: {record['input']}")
         else:
-            print("Некорректный номер файла.")
+            print(f"Ошибка при обработке {record['input']}: {record['error']}", file=sys.stderr)
+
+    if several_inputs or args.summary:
+        summary_path = args.summary or os.path.join(args.output or os.getcwd(), 'run_summary.json')
+        write_run_summary(summary_path, records, time.perf_counter() - started,
+                          min(args.jobs or os.cpu_count() or 1, len(tasks)))
+        failed = sum(record['status'] != 'ok' for record in records)
+        print(f"Обработано файлов: {len(records) - failed} из {len(records)}. Сводка: {summary_path}")
+
+    return 0 if all(record['status'] == 'ok' for record in records) else 1
+
+
+# Main logic
+if __name__ == "__main__":
+    sys.exit(main())